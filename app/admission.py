@@ -0,0 +1,119 @@
+from asyncio import CancelledError, TimeoutError, get_running_loop, wait_for
+from collections import deque
+from math import ceil
+from os import environ
+from time import monotonic, perf_counter
+from fastapi.responses import ORJSONResponse
+from db.stats import Histogram
+
+# Requests are admitted per class (reads are GET and HEAD, the rest are writes) up to a number
+# running at once, a bounded number more wait in line for up to a deadline and the rest are
+# answered 503 straight away instead of queueing on the connection pool. A limit of 0 admits
+# everything. Optionally each client address also gets a token bucket, over it means 429.
+EXEMPT = {"/metrics", "/api/v1/cache", "/api/v1/changes"}
+retry_after = int(environ.get('ADMISSION_RETRY_AFTER', 1))
+rate = float(environ.get('RATE_LIMIT', 0))
+burst = float(environ.get('RATE_LIMIT_BURST', 20))
+max_clients = 10000
+
+
+class Limiter:
+    def __init__(self, limit, queue, timeout):
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiters = deque()
+        self.wait = Histogram()
+        self.rejected = {"queue_full": 0, "timeout": 0}
+
+    async def acquire(self):
+        # Returns why the request was turned away, or None once it holds a slot
+        if not self.limit or (self.active < self.limit and not self.waiters):
+            self.active += 1
+            return None
+        if len(self.waiters) >= self.queue:
+            self.rejected["queue_full"] += 1
+            return "queue_full"
+        waiter = get_running_loop().create_future()
+        self.waiters.append(waiter)
+        started = perf_counter()
+        try:
+            # release() hands its slot over by resolving the future, active stays as it is
+            await wait_for(waiter, self.timeout)
+        except TimeoutError:
+            self.rejected["timeout"] += 1
+            return "timeout"
+        except CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            self.wait.observe(perf_counter() - started)
+        return None
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class RateLimiter:
+    # Token buckets by client address, refilled at rate per second up to burst
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.limited = 0
+
+    def allow(self, client):
+        # Returns 0 when the request may go ahead, otherwise the seconds until it could
+        now = monotonic()
+        tokens, last = self.buckets.get(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[client] = (tokens, now)
+            self.limited += 1
+            return (1 - tokens) / self.rate
+        if client not in self.buckets and len(self.buckets) >= max_clients:
+            # Forget the clients whose buckets have filled up again
+            self.buckets = {key: (value, at) for key, (value, at) in self.buckets.items()
+                            if value + (now - at) * self.rate < self.burst}
+        self.buckets[client] = (tokens - 1, now)
+        return 0
+
+
+limiters = {"read": Limiter(int(environ.get('ADMISSION_READS', 0)), int(environ.get('ADMISSION_READ_QUEUE', 100)),
+                            float(environ.get('ADMISSION_TIMEOUT', 1))),
+            "write": Limiter(int(environ.get('ADMISSION_WRITES', 0)), int(environ.get('ADMISSION_WRITE_QUEUE', 100)),
+                             float(environ.get('ADMISSION_TIMEOUT', 1)))}
+rate_limiter = RateLimiter(rate, burst) if rate else None
+
+
+def reject(status, seconds, detail):
+    return ORJSONResponse({"detail": detail}, status_code=status, headers={"Retry-After": str(ceil(seconds))})
+
+
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT:
+            return await self.app(scope, receive, send)
+        if rate_limiter is not None:
+            wait = rate_limiter.allow(scope["client"][0] if scope.get("client") else "")
+            if wait:
+                return await reject(429, wait, "too many requests")(scope, receive, send)
+        limiter = limiters["read" if scope["method"] in ("GET", "HEAD") else "write"]
+        if await limiter.acquire() is not None:
+            return await reject(503, retry_after, "server busy")(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
@@ -2,230 +2,547 @@ import sys
 import os
 sys.path.append(os.getcwd())
 
+import anyio
+from decimal import Decimal, InvalidOperation
+from re import findall
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request
+from fastapi.responses import ORJSONResponse, PlainTextResponse, Response, StreamingResponse
 from os import environ, path
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, ValidationError, condecimal, conint, conlist, parse_obj_as
 from uvicorn import run
-from db.dbconnection import cursor
+from zlib import crc32
+from app import changes
+from app.cache import PRIMARY_COOKIE, cache, encode, key, lookup, not_modified, store, variant
+from app.admission import AdmissionMiddleware
+from app.metrics import MetricsMiddleware, exposition
+from app.tenants import TenantMiddleware
+from db.dbconnection import close, database, get_db
+from db.migrate import migrate
+from db.reconcile import reconcile
+from db.settings import list_json, read_your_writes, replica_settings
+from db.bulk import export_csv, export_ndjson, load, parse_csv
+from db import queries
+
+# Prices are NUMERIC(10, 2), a value that doesn't fit is turned away before the database overflows
+Price = condecimal(max_digits=10, decimal_places=2)
 
 class Menu(BaseModel):
-    title: str
-    description: str
+    # The columns are VARCHAR(150), longer text is a 422 here rather than an error from the database
+    title: str = Field(max_length=150)
+    description: str = Field(max_length=150)
 
 class Dish(Menu):
-    price: str
+    price: Price
+
+class SubmenuImport(Menu):
+    dishes: list[Dish] = []
+
+class MenuImport(Menu):
+    submenus: list[SubmenuImport] = []
+
+# Response shapes for the docs, the GET handlers return encoded bodies and skip validation
+class MenuOut(Menu):
+    id: str
+    submenus_count: int
+    dishes_count: int
+
+class SubmenuOut(Menu):
+    id: str
+    dishes_count: int
+
+class DishOut(Menu):
+    id: str
+    price: str | None
+
+class DishHit(DishOut):
+    menu_id: str
+    submenu_id: str
+    rank: float
+
+class PriceStats(BaseModel):
+    dishes: int
+    min_price: str | None
+    avg_price: str | None
+    max_price: str | None
+
+# Collections are paged by id, fields= picks a subset of the projection's columns
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Ids are INT columns, a larger number can't name a row and would overflow the parameter
+MAX_ID = 2 ** 31 - 1
+Id = conint(ge=0, le=MAX_ID)
+
+def projection(fields, columns):
+    if fields is None:
+        return list(columns)
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    unknown = [name for name in names if name not in columns]
+    if unknown or not names:
+        raise HTTPException(status_code=422, detail=f"unknown fields: {', '.join(unknown) or fields}")
+    # In the projection's order whatever the client's, so each subset is one prepared statement
+    return [name for name in columns if name in names]
+
+def etag(request, version):
+    if request.query_params:
+        version += "-" + format(crc32(variant(request).encode("utf-8")), "x")
+    return f'"{version}"'
+
+def unchanged(request, version):
+    # The 304 response when If-None-Match already holds the tag of version
+    if version is not None and not_modified(request, tag := etag(request, version)):
+        return Response(status_code=304, headers={"ETag": tag})
+    return None
+
+async def revalidate(request, db, query, *args):
+    # Only a client sending If-None-Match gets the versions read first, to answer 304 before
+    # the full query runs. Everyone else gets the tag from the version read with the body.
+    if "if-none-match" not in request.headers:
+        return None
+    return unchanged(request, await db.fetchval(query, *args))
+
+def versions(rows, position, limit):
+    # "id:version,..." of the page's rows and "+" when there is a next page, the same string
+    # select_json builds
+    return ",".join(f"{row[-1]}:{row[position]}" for row in rows[:limit]) + (",+" if len(rows) > limit else "")
+
+def page_version(versions):
+    # A page can't change without one of its rows changing version or the next page appearing
+    return format(crc32(versions.encode("utf-8")), "x")
+
+def keyset(query, after):
+    # Cursors are the keyset values of the last row joined by commas, e.g. "12.50,17"
+    if after is None:
+        return query.start
+    values = str(after).split(",")
+    try:
+        if len(values) != len(query.keys):
+            raise ValueError(after)
+        cursor = tuple(kind(value) for kind, value in zip(query.keys.values(), values))
+        for kind, value in zip(query.keys.values(), cursor):
+            if kind is int and not 0 <= value <= MAX_ID:
+                raise ValueError(after)
+            if kind is Decimal:
+                # Finite and within the price column, NaN or Infinity would match no row
+                parse_obj_as(Price, value)
+        return cursor
+    except (ValueError, ArithmeticError):
+        raise HTTPException(status_code=422, detail=f"invalid cursor: {after}")
+
+async def page(request, db, query, fields, limit, after, *args):
+    # The statement ends with "> cursor ORDER BY keys LIMIT $n+1" and its last columns are the
+    # raw keys used as the cursor
+    names = projection(fields, query.columns)
+    cursor = keyset(query, after)
+    if query.version is not None and "if-none-match" in request.headers:
+        # The same page with only its versions and keys, no bigger than the page itself
+        rows = await db.fetch(query.select_version(), *args, *cursor, limit + 1)
+        if response := unchanged(request, page_version(versions(rows, 0, limit))):
+            return response
+    headers = {}
+    if list_json == "postgres":
+        # The body comes back as one text value, Python never sees the rows
+        content, cursor, read = await db.fetchrow(query.select_json(names), *args, *cursor, limit + 1)
+        content = content.encode("utf-8")
+    else:
+        values = await db.fetch(query.select(names), *args, *cursor, limit + 1)
+        keys = len(query.keys)
+        cursor = ",".join(map(str, values[limit - 1][-keys:])) if len(values) > limit else None
+        content = [dict(zip(names, value)) for value in values[:limit]]
+        read = versions(values, len(names), limit)
+    if cursor is not None:
+        headers.update({"Link": f'<{request.url.include_query_params(after=cursor)}>; rel="next"',
+                        "X-Next-Cursor": str(cursor)})
+    if query.version is None:
+        return Response(encode(content), headers=headers, media_type="application/json")
+    headers["ETag"] = etag(request, page_version(read))
+    return await store(request, content, headers)
+
+DISH_ORDERS = {"id": queries.GET_DISHES, "price": queries.GET_DISHES_BY_PRICE,
+               "-price": queries.GET_DISHES_BY_PRICE_DESC}
+
+# Read-only handlers go to a replica unless the client wrote within read_your_writes seconds
+async def get_read_db(request: Request):
+    async with database(read=PRIMARY_COOKIE not in request.cookies) as db:
+        yield db
+
+async def get_tenant(request: Request):
+    # Set by TenantMiddleware from the /t/<tenant> prefix or the X-Tenant header
+    return request.state.tenant
+
+async def get_write_db(response: Response, db=Depends(get_db)):
+    if replica_settings and read_your_writes:
+        response.set_cookie(PRIMARY_COOKIE, "1", max_age=read_your_writes, httponly=True)
+    return db
+
+async def json_array(rows, chunk_size=65536):
+    # Stream the rows as one JSON array, writing in chunks instead of once per row
+    chunk = "["
+    async for row in rows:
+        chunk += row[0] if chunk == "[" else "," + row[0]
+        if len(chunk) >= chunk_size:
+            yield chunk.encode("utf-8")
+            chunk = ""
+    yield (chunk + "]").encode("utf-8")
 
 # FastAPI app and request body
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+# Added first so it runs inside the metrics, which then count its 503 and 429 answers. The
+# tenant is taken off the path before admission compares it with the exempt paths.
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(TenantMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 @app.on_event("startup")
-def startup():
-    cursor.execute("""
-    DROP TABLE IF EXISTS menus, submenus, dishes;
-    CREATE TABLE menus (
-        id SERIAL PRIMARY KEY, 
-        title VARCHAR(150), 
-        description VARCHAR(150));
-    CREATE TABLE submenus (
-        id SERIAL PRIMARY KEY, 
-        menu INT REFERENCES menus (id) ON DELETE CASCADE,
-        title VARCHAR(150), description VARCHAR(150));
-    CREATE TABLE dishes (
-        id SERIAL PRIMARY KEY, 
-        submenu INT REFERENCES submenus (id) ON DELETE CASCADE,
-        title VARCHAR(150),
-        description VARCHAR(150),
-        price VARCHAR(150))
-    """)
-    cursor.connection.commit()
+async def startup():
+    # Multi-worker launchers migrate once before the workers start and turn this off
+    if environ.get("MIGRATE_ON_STARTUP") != "False":
+        await migrate()
 
 @app.on_event("shutdown")
-def shutdown():
-    cursor.execute("DROP TABLE IF EXISTS menus, submenus, dishes")
-    cursor.connection.commit()
-    cursor.close()
-    cursor.connection.commit()
+async def shutdown():
+    await changes.stop()
+    await close()
 
 # Menus
-@app.get("/api/v1/menus", status_code=200)
-def get_menus():
-    cursor.execute("""
-    SELECT
-        m.id::text,
-        m.title,
-        m.description,
-        COUNT(DISTINCT s.id),
-        COUNT(DISTINCT d.id)
-    FROM menus m
-    LEFT OUTER JOIN submenus s ON m.id = s.menu
-    LEFT OUTER JOIN dishes d ON s.id = d.submenu
-    GROUP BY m.id
-    """)
-    values = cursor.fetchall()
+@app.get("/api/v1/menus", status_code=200, response_model=list[MenuOut])
+async def get_menus(request: Request, limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: Id | None = None,
+                    fields: str | None = None, tenant=Depends(get_tenant), db=Depends(get_read_db)):
+    if cached := await lookup(request):
+        return cached
+    return await page(request, db, queries.GET_MENUS, fields, limit, after, tenant)
+
+@app.get("/api/v1/menus/tree", status_code=200)
+async def get_menus_tree(tenant=Depends(get_tenant), db=Depends(get_db)):
+    return StreamingResponse(json_array(db.iterate(queries.GET_MENUS_TREE, tenant)), media_type="application/json")
+
+@app.get("/api/v1/menus/{target_menu_id}/tree", status_code=200)
+async def get_menu_tree(target_menu_id: Id, tenant=Depends(get_tenant), db=Depends(get_db)):
+    values = await db.fetchval(queries.GET_MENU_TREE, tenant, target_menu_id)
     if values:
-        keys = ['id', 'title', 'description', 'submenus_count', 'dishes_count']
-        return [dict(zip(keys, value)) for value in values]
+        return Response(values, media_type="application/json")
     else:
-        return values
-
-@app.get("/api/v1/menus/{target_menu_id}", status_code=200)
-def get_menu(target_menu_id: int, ):
-    cursor.execute(f"""
-    SELECT
-        m.id::text,
-        m.title,
-        m.description,
-        COUNT(DISTINCT s.id),
-        COUNT(DISTINCT d.id)
-    FROM menus m
-    LEFT OUTER JOIN submenus s ON m.id = s.menu
-    LEFT OUTER JOIN dishes d ON s.id = d.submenu
-    WHERE m.id = {target_menu_id}
-    GROUP BY m.id
-    """)
-    values = cursor.fetchone()
+        raise HTTPException(status_code=404, detail="menu not found")
+
+@app.get("/api/v1/menus/{target_menu_id}", status_code=200, response_model=MenuOut)
+async def get_menu(request: Request, target_menu_id: Id, tenant=Depends(get_tenant), db=Depends(get_read_db)):
+    if cached := await lookup(request):
+        return cached
+    if response := await revalidate(request, db, queries.MENU_VERSION, tenant, target_menu_id):
+        return response
+    values = await db.fetchrow(queries.GET_MENU, tenant, target_menu_id)
     if values:
         keys = ['id', 'title', 'description', 'submenus_count', 'dishes_count']
-        return dict(zip(keys, values))
+        return await store(request, dict(zip(keys, values)), {"ETag": etag(request, values[-1])})
     else:
         raise HTTPException(status_code=404, detail="menu not found")
 
 @app.post("/api/v1/menus", status_code=201)
-def create_menu(menu: Menu, ):
-    cursor.execute(f"INSERT INTO menus (title, description) VALUES ('{menu.title}', '{menu.description}') RETURNING id")
-    return {"id": str(cursor.fetchone()[0]), "title": menu.title, "description": menu.description}
+async def create_menu(request: Request, menu: Menu, tenant=Depends(get_tenant), db=Depends(get_write_db)):
+    menu_id = await db.fetchval(queries.CREATE_MENU, tenant, menu.title, menu.description)
+    await cache.invalidate(f"{key(request)}/{menu_id}")
+    return {"id": str(menu_id), "title": menu.title, "description": menu.description}
 
 @app.patch("/api/v1/menus/{target_menu_id}", status_code=200)
-def update_menu(target_menu_id: int, menu: Menu, ):
-    cursor.execute(f"UPDATE menus SET (title, description) = ('{menu.title}', '{menu.description}') "
-                   f"WHERE id = {target_menu_id}")
-    cursor.connection.commit()
+async def update_menu(request: Request, target_menu_id: Id, menu: Menu, tenant=Depends(get_tenant),
+                      db=Depends(get_write_db)):
+    await db.execute(queries.UPDATE_MENU, tenant, menu.title, menu.description, target_menu_id)
+    await cache.invalidate(key(request), descendants=False)
     return {"id": str(target_menu_id), "title": menu.title, "description": menu.description}
 
 @app.delete("/api/v1/menus/{target_menu_id}", status_code=200)
-def delete_menu(target_menu_id: int, ):
-    return cursor.execute(f"DELETE FROM menus WHERE id={target_menu_id}")
+async def delete_menu(request: Request, target_menu_id: Id, tenant=Depends(get_tenant), db=Depends(get_write_db)):
+    await db.execute(queries.DELETE_MENU, tenant, target_menu_id)
+    await cache.invalidate(key(request))
 
 # Submenus
-@app.get("/api/v1/menus/{target_menu_id}/submenus", status_code=200)
-def get_submenus(target_menu_id: int, ):
-    cursor.execute(f"""
-    SELECT
-        s.id::text,
-        s.title,
-        s.description,
-        COUNT(DISTINCT d.id)
-    FROM menus m
-    INNER JOIN submenus s ON m.id = s.menu
-    LEFT OUTER JOIN dishes d ON s.id = d.submenu
-    WHERE m.id = {target_menu_id}
-    GROUP BY s.id
-    """)
-    values = cursor.fetchall()
-    if values:
-        keys = ['id', 'title', 'description', 'dishes_count']
-        return [dict(zip(keys, value)) for value in values]
-    else:
-        return values
-
-@app.get("/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}", status_code=200)
-def get_submenu(target_menu_id: int, target_submenu_id: int, ):
-    cursor.execute(f"""
-    SELECT
-        s.id::text,
-        s.title,
-        s.description,
-        COUNT(DISTINCT d.id)
-    FROM menus m
-    INNER JOIN submenus s ON m.id = s.menu
-    LEFT OUTER JOIN dishes d ON s.id = d.submenu
-    WHERE m.id = {target_menu_id} AND s.id = {target_submenu_id}
-    GROUP BY s.id
-    """)
-    values = cursor.fetchone()
+@app.get("/api/v1/menus/{target_menu_id}/submenus", status_code=200, response_model=list[SubmenuOut])
+async def get_submenus(request: Request, target_menu_id: Id, limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                       after: Id | None = None, fields: str | None = None, tenant=Depends(get_tenant),
+                       db=Depends(get_read_db)):
+    if cached := await lookup(request):
+        return cached
+    return await page(request, db, queries.GET_SUBMENUS, fields, limit, after, tenant, target_menu_id)
+
+@app.get("/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}", status_code=200, response_model=SubmenuOut)
+async def get_submenu(request: Request, target_menu_id: Id, target_submenu_id: Id, tenant=Depends(get_tenant),
+                      db=Depends(get_read_db)):
+    if cached := await lookup(request):
+        return cached
+    if response := await revalidate(request, db, queries.SUBMENU_VERSION, tenant, target_menu_id, target_submenu_id):
+        return response
+    values = await db.fetchrow(queries.GET_SUBMENU, tenant, target_menu_id, target_submenu_id)
     if values:
         keys = ['id', 'title', 'description', 'dishes_count']
-        return dict(zip(keys, values))
+        return await store(request, dict(zip(keys, values)), {"ETag": etag(request, values[-1])})
     else:
         raise HTTPException(status_code=404, detail="submenu not found")
 
 @app.post("/api/v1/menus/{target_menu_id}/submenus", status_code=201)
-def create_submenu(target_menu_id: int, menu: Menu, ):
-    cursor.execute(f"INSERT INTO submenus (menu, title, description)"
-                   f"VALUES ({target_menu_id}, '{menu.title}', '{menu.description}')"
-                   f"RETURNING id")
-    return {"id": str(cursor.fetchone()[0]), "title": menu.title, "description": menu.description}
+async def create_submenu(request: Request, target_menu_id: Id, menu: Menu, tenant=Depends(get_tenant),
+                         db=Depends(get_write_db)):
+    submenu_id = await db.fetchval(queries.CREATE_SUBMENU, tenant, target_menu_id, menu.title, menu.description)
+    if submenu_id is None:
+        raise HTTPException(status_code=404, detail="menu not found")
+    await cache.invalidate(f"{key(request)}/{submenu_id}")
+    return {"id": str(submenu_id), "title": menu.title, "description": menu.description}
 
 @app.patch("/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}", status_code=200)
-def update_submenu(target_menu_id: int, target_submenu_id: int, menu: Menu, ):
-    cursor.execute(f"UPDATE submenus SET (title, description) = ('{menu.title}', '{menu.description}') "
-                   f"WHERE menu={target_menu_id} AND id={target_submenu_id}")
+async def update_submenu(request: Request, target_menu_id: Id, target_submenu_id: Id, menu: Menu,
+                         tenant=Depends(get_tenant), db=Depends(get_write_db)):
+    await db.execute(queries.UPDATE_SUBMENU, tenant, menu.title, menu.description, target_menu_id, target_submenu_id)
+    await cache.invalidate(key(request), descendants=False)
     return {"id": str(target_submenu_id), "title": menu.title, "description": menu.description}
 
 @app.delete("/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}", status_code=200)
-def delete_submenu(target_menu_id: int, target_submenu_id: int, ):
-    return cursor.execute(f"DELETE FROM submenus WHERE menu={target_menu_id} AND id={target_submenu_id}")
+async def delete_submenu(request: Request, target_menu_id: Id, target_submenu_id: Id, tenant=Depends(get_tenant),
+                         db=Depends(get_write_db)):
+    await db.execute(queries.DELETE_SUBMENU, tenant, target_menu_id, target_submenu_id)
+    await cache.invalidate(key(request))
 
 # Dishes
-@app.get("/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}/dishes", status_code=200)
-def get_dishes(target_menu_id: int, target_submenu_id: int, ):
-    cursor.execute(f"""
-    SELECT
-        d.id::text,
-        d.title,
-        d.description,
-        d.price
-    FROM menus m
-    INNER JOIN submenus s ON m.id = s.menu
-    INNER JOIN dishes d ON s.id = d.submenu
-    WHERE m.id = {target_menu_id} AND s.id = {target_submenu_id}
-    GROUP BY d.id
-    """)
-    values = cursor.fetchall()
-    if values:
-        keys = ['id', 'title', 'description', 'price']
-        return [dict(zip(keys, value)) for value in values]
-    else:
-        return values
-
-@app.get("/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}/dishes/{target_dish_id}", status_code=200)
-def get_dish(target_menu_id: int, target_submenu_id: int, target_dish_id: int, ):
-    cursor.execute(f"""
-    SELECT
-        d.id::text,
-        d.title,
-        d.description,
-        d.price
-    FROM menus m
-    INNER JOIN submenus s ON m.id = s.menu
-    LEFT OUTER JOIN dishes d ON s.id = d.submenu
-    WHERE m.id = {target_menu_id} AND s.id = {target_submenu_id} AND d.id = {target_dish_id}
-    GROUP BY d.id
-    """)
-    values = cursor.fetchone()
+@app.get("/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}/dishes", status_code=200,
+         response_model=list[DishOut])
+async def get_dishes(request: Request, target_menu_id: Id, target_submenu_id: Id,
+                     limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: str | None = None,
+                     fields: str | None = None, min_price: Price | None = None, max_price: Price | None = None,
+                     order_by: str = Query("id", regex="^(id|price|-price)$"), tenant=Depends(get_tenant),
+                     db=Depends(get_read_db)):
+    if cached := await lookup(request):
+        return cached
+    return await page(request, db, DISH_ORDERS[order_by], fields, limit, after, tenant, target_menu_id,
+                      target_submenu_id, min_price, max_price)
+
+@app.get("/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}/dishes/{target_dish_id}", status_code=200,
+         response_model=DishOut)
+async def get_dish(request: Request, target_menu_id: Id, target_submenu_id: Id, target_dish_id: Id,
+                   tenant=Depends(get_tenant), db=Depends(get_read_db)):
+    if cached := await lookup(request):
+        return cached
+    if response := await revalidate(request, db, queries.DISH_VERSION, tenant, target_menu_id, target_submenu_id,
+                                    target_dish_id):
+        return response
+    values = await db.fetchrow(queries.GET_DISH, tenant, target_menu_id, target_submenu_id, target_dish_id)
     if values:
         keys = ['id', 'title', 'description', 'price']
-        return dict(zip(keys, values))
+        return await store(request, dict(zip(keys, values)), {"ETag": etag(request, values[-1])})
     else:
         raise HTTPException(status_code=404, detail="dish not found")
 
 @app.post("/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}/dishes", status_code=201)
-def create_submenu(target_submenu_id: int, dish: Dish, ):
-    cursor.execute(f"INSERT INTO dishes (submenu, title, description, price) "
-                   f"VALUES ('{target_submenu_id}', '{dish.title}', '{dish.description}', '{dish.price}') "
-                   f"RETURNING id")
-    return {"id": str(cursor.fetchone()[0]), "title": dish.title, "description": dish.description, "price": dish.price}
+async def create_dish(request: Request, target_menu_id: Id, target_submenu_id: Id, dish: Dish,
+                      tenant=Depends(get_tenant), db=Depends(get_write_db)):
+    dish_id = await db.fetchval(queries.CREATE_DISH, tenant, target_menu_id, target_submenu_id, dish.title,
+                                dish.description, dish.price)
+    if dish_id is None:
+        raise HTTPException(status_code=404, detail="submenu not found")
+    await cache.invalidate(f"{key(request)}/{dish_id}")
+    return {"id": str(dish_id), "title": dish.title, "description": dish.description, "price": f"{dish.price:.2f}"}
 
 @app.patch("/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}/dishes/{target_dish_id}", status_code=200)
-def update_submenu(target_dish_id: int, dish: Dish, ):
-    cursor.execute(f"UPDATE dishes SET (title, description, price) = ('{dish.title}', '{dish.description}', '{dish.price}') "
-                   f"WHERE id={target_dish_id}")
-    return {"id": str(target_dish_id), "title": dish.title, "description": dish.description, "price": dish.price}
+async def update_dish(request: Request, target_menu_id: Id, target_submenu_id: Id, target_dish_id: Id, dish: Dish,
+                      tenant=Depends(get_tenant), db=Depends(get_write_db)):
+    await db.execute(queries.UPDATE_DISH, tenant, dish.title, dish.description, dish.price, target_menu_id,
+                     target_submenu_id, target_dish_id)
+    await cache.invalidate(key(request), descendants=False)
+    return {"id": str(target_dish_id), "title": dish.title, "description": dish.description,
+            "price": f"{dish.price:.2f}"}
 
 @app.delete("/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}/dishes/{target_dish_id}", status_code=200)
-def delete_submenu(target_dish_id: int, ):
-    return cursor.execute(f"DELETE FROM dishes WHERE id={target_dish_id}")
+async def delete_dish(request: Request, target_menu_id: Id, target_submenu_id: Id, target_dish_id: Id,
+                      tenant=Depends(get_tenant), db=Depends(get_write_db)):
+    await db.execute(queries.DELETE_DISH, tenant, target_menu_id, target_submenu_id, target_dish_id)
+    await cache.invalidate(key(request))
+
+# Price stats
+@app.get("/api/v1/menus/{target_menu_id}/stats", status_code=200, response_model=PriceStats)
+async def get_menu_stats(target_menu_id: Id, tenant=Depends(get_tenant), db=Depends(get_read_db)):
+    values = await db.fetchrow(queries.MENU_STATS, tenant, target_menu_id)
+    if values:
+        return dict(zip(["dishes", "min_price", "avg_price", "max_price"], values))
+    else:
+        raise HTTPException(status_code=404, detail="menu not found")
+
+@app.get("/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}/stats", status_code=200,
+         response_model=PriceStats)
+async def get_submenu_stats(target_menu_id: Id, target_submenu_id: Id, tenant=Depends(get_tenant),
+                            db=Depends(get_read_db)):
+    values = await db.fetchrow(queries.SUBMENU_STATS, tenant, target_menu_id, target_submenu_id)
+    if values:
+        return dict(zip(["dishes", "min_price", "avg_price", "max_price"], values))
+    else:
+        raise HTTPException(status_code=404, detail="submenu not found")
+
+# Search
+def tsquery(text):
+    # Every word is a prefix and all of them must match. Only word characters reach to_tsquery,
+    # so the operators of its syntax can't come from the client.
+    words = findall(r"\w+", text.lower())
+    if not words:
+        raise HTTPException(status_code=422, detail="nothing to search for")
+    return " & ".join(f"{word}:*" for word in words)
+
+@app.get("/api/v1/search", status_code=200, response_model=list[DishHit])
+async def search_dishes(request: Request, q: str, limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                        after: str | None = None, fields: str | None = None, tenant=Depends(get_tenant),
+                        db=Depends(get_read_db)):
+    # Results are neither cached nor tagged, every write could change any of them
+    return await page(request, db, queries.SEARCH_DISHES, fields, limit, after, tenant, tsquery(q))
+
+# Batch: several writes in one transaction and one commit. Operations address rows with the
+# paths of the single handlers; "$n" in a path stands for the id created by operation n.
+MAX_BATCH_SIZE = 1000
+
+class Operation(BaseModel):
+    method: str = Field(regex="^(POST|PATCH|DELETE)$")
+    path: str
+    body: dict | None = None
+
+# (method, path template): body model, statement, its arguments from the path ids and the body
+BATCH_WRITES = {
+    ("POST", "/api/v1/menus"):
+        (Menu, queries.CREATE_MENU, lambda ids, data: (data.title, data.description)),
+    ("PATCH", "/api/v1/menus/{id}"):
+        (Menu, queries.UPDATE_MENU, lambda ids, data: (data.title, data.description, *ids)),
+    ("DELETE", "/api/v1/menus/{id}"):
+        (None, queries.DELETE_MENU, lambda ids, data: ids),
+    ("POST", "/api/v1/menus/{id}/submenus"):
+        (Menu, queries.CREATE_SUBMENU, lambda ids, data: (*ids, data.title, data.description)),
+    ("PATCH", "/api/v1/menus/{id}/submenus/{id}"):
+        (Menu, queries.UPDATE_SUBMENU, lambda ids, data: (data.title, data.description, *ids)),
+    ("DELETE", "/api/v1/menus/{id}/submenus/{id}"):
+        (None, queries.DELETE_SUBMENU, lambda ids, data: ids),
+    ("POST", "/api/v1/menus/{id}/submenus/{id}/dishes"):
+        (Dish, queries.CREATE_DISH, lambda ids, data: (*ids, data.title, data.description, data.price)),
+    ("PATCH", "/api/v1/menus/{id}/submenus/{id}/dishes/{id}"):
+        (Dish, queries.UPDATE_DISH, lambda ids, data: (data.title, data.description, data.price, *ids)),
+    ("DELETE", "/api/v1/menus/{id}/submenus/{id}/dishes/{id}"):
+        (None, queries.DELETE_DISH, lambda ids, data: ids),
+}
+
+def resolve(index, operation, results):
+    # Returns the path template, the concrete path and its ids
+    parts = operation.path.rstrip("/").split("/")
+    ids = []
+    for position in range(4, len(parts), 2):
+        segment, parts[position] = parts[position], "{id}"
+        if segment.startswith("$") and segment[1:].isdigit() and int(segment[1:]) < index \
+                and results[int(segment[1:])]["status"] == 201:
+            ids.append(int(results[int(segment[1:])]["body"]["id"]))
+        elif segment.isdigit() and int(segment) <= MAX_ID:
+            ids.append(int(segment))
+        else:
+            raise HTTPException(status_code=422, detail=f"operation {index}: invalid id {segment}")
+    template = "/".join(parts)
+    for position, row_id in zip(range(4, len(parts), 2), ids):
+        parts[position] = str(row_id)
+    return template, "/".join(parts), ids
+
+@app.post("/api/v1/batch", status_code=200)
+async def batch(operations: conlist(Operation, min_items=1, max_items=MAX_BATCH_SIZE), tenant=Depends(get_tenant),
+                db=Depends(get_write_db)):
+    results, invalidate = [], []
+    async with db.transaction():
+        for index, operation in enumerate(operations):
+            template, path, ids = resolve(index, operation, results)
+            if (operation.method, template) not in BATCH_WRITES:
+                raise HTTPException(status_code=422, detail=f"operation {index}: no {operation.method} {template}")
+            model, query, arguments = BATCH_WRITES[operation.method, template]
+            try:
+                data = model.parse_obj(operation.body) if model else None
+            except ValidationError as error:
+                raise HTTPException(status_code=422, detail=f"operation {index}: {error.errors()}")
+            if operation.method == "POST":
+                row_id = await db.fetchval(query, tenant, *arguments(ids, data))
+                path = f"{path}/{row_id}"
+            elif await db.execute(query, tenant, *arguments(ids, data)):
+                row_id = ids[-1]
+            else:
+                row_id = None
+            if row_id is None:
+                raise HTTPException(status_code=404, detail=f"operation {index}: {path} not found")
+            body = None if data is None else {"id": str(row_id), "title": data.title,
+                                              "description": data.description}
+            if model is Dish:
+                body["price"] = f"{data.price:.2f}"
+            results.append({"status": 201 if operation.method == "POST" else 200, "body": body})
+            invalidate.append((path, operation.method != "PATCH"))
+    # After the commit, so a concurrent read can't cache the old rows again
+    for path, descendants in invalidate:
+        await cache.invalidate(f"/{tenant}{path}", descendants)
+    return results
+
+# Bulk import and export
+@app.post("/api/v1/import", status_code=201)
+async def import_menus(request: Request, menus: list[MenuImport], tenant=Depends(get_tenant),
+                       db=Depends(get_write_db)):
+    counts = await load(db, [menu.dict() for menu in menus], tenant)
+    await cache.invalidate(f"/{tenant}/api/v1/menus", descendants=False)
+    return counts
+
+@app.post("/api/v1/import/csv", status_code=201)
+async def import_menus_csv(request: Request, tenant=Depends(get_tenant), db=Depends(get_write_db)):
+    try:
+        menus = parse_csv((await request.body()).decode("utf-8"))
+    except (KeyError, ValueError, InvalidOperation) as error:
+        raise HTTPException(status_code=422, detail=f"invalid csv: {error}")
+    counts = await load(db, menus, tenant)
+    await cache.invalidate(f"/{tenant}/api/v1/menus", descendants=False)
+    return counts
+
+@app.get("/api/v1/export", status_code=200)
+async def export_menus(format: str = Query("ndjson", regex="^(ndjson|csv)$"), tenant=Depends(get_tenant),
+                       db=Depends(get_db)):
+    if format == "csv":
+        return StreamingResponse(export_csv(db, tenant), media_type="text/csv")
+    else:
+        return StreamingResponse(export_ndjson(db, tenant), media_type="application/x-ndjson")
+
+# Change feed, one Server-Sent Event per committed write of the tenant
+@app.get("/api/v1/changes", status_code=200)
+async def get_changes(last_event_id: str | None = Header(None), tenant=Depends(get_tenant)):
+    if not await changes.start():
+        raise HTTPException(status_code=503, detail="change feed unavailable")
+    queue, backlog = changes.subscribe(tenant, last_event_id)
+    return StreamingResponse(changes.stream(queue, backlog), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Cache
+@app.get("/api/v1/cache", status_code=200)
+async def get_cache_stats():
+    return cache.stats()
+
+# Counters are kept exact by triggers, this repairs the tenant's if they ever drift and drops
+# its cached menus, any count below them may have changed. db/reconcile.py does every tenant.
+@app.post("/api/v1/reconcile", status_code=200)
+async def reconcile_counters(tenant=Depends(get_tenant)):
+    repaired = await reconcile(tenant)
+    await cache.invalidate(f"/{tenant}/api/v1/menus")
+    return repaired
+
+# Metrics
+@app.get("/metrics", status_code=200, include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(exposition(cache.stats()), media_type="text/plain; version=0.0.4")
+
+
+def check_workers(workers):
+    # The memory cache lives in one process, other workers would keep serving what a write
+    # in this one invalidated
+    if workers > 1 and environ.get("CACHE_BACKEND", "memory") == "memory":
+        raise SystemExit("CACHE_BACKEND=memory is per process, use redis or none with more than one worker")
+
+async def migrate_and_close():
+    # One event loop for both, the async engine's pool can't be closed from a loop it wasn't opened on
+    try:
+        await migrate()
+    finally:
+        await close()
+
+def migrate_once():
+    anyio.run(migrate_and_close)
+    environ["MIGRATE_ON_STARTUP"] = "False"
 
 
 # Load environment
@@ -235,5 +552,10 @@ if __name__ == "__main__":
         load_dotenv(dotenv_path)
     app_ip = environ.get('WSGI_HOST')
     app_port = int(environ.get('WSGI_PORT'))
-    run(app, host=app_ip, port=app_port)
-
+    workers = int(environ.get('WSGI_WORKERS', 1))
+    if workers > 1:
+        check_workers(workers)
+        migrate_once()
+        run("app.api:app", host=app_ip, port=app_port, workers=workers)
+    else:
+        run(app, host=app_ip, port=app_port)
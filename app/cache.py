@@ -0,0 +1,228 @@
+import orjson
+from collections import OrderedDict
+from json import dumps, loads
+from os import environ
+from time import monotonic, perf_counter
+from urllib.parse import urlencode
+from fastapi import Request, Response
+from app.metrics import serialization
+from db.settings import read_your_writes, replica_settings
+
+# Entries are keyed by the tenant and route path (e.g. /acme/api/v1/menus/1/submenus) and hold
+# one serialized body per query string, so a path and everything below it can be dropped in one go.
+# Only the query parameters the cached routes declare make a variant, others can't change the body.
+PARAMS = {"limit", "after", "fields", "min_price", "max_price", "order_by"}
+
+# Set on a client's writes when there are replicas, its reads then go to the primary
+PRIMARY_COOKIE = "ylab_primary"
+
+
+def ancestors(path):
+    parts = path.rstrip("/").split("/")
+    return ["/".join(parts[:i]) for i in range(2, len(parts) + 1)]
+
+
+class Cache:
+    backend = "none"
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, path, variant):
+        self.misses += 1
+
+    async def set(self, path, variant, body):
+        pass
+
+    async def invalidate(self, path, descendants=True):
+        pass
+
+    async def clear(self):
+        pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"backend": self.backend, "hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+class MemoryCache(Cache):
+    backend = "memory"
+
+    def __init__(self, size, ttl):
+        super().__init__()
+        self.size = size
+        self.ttl = ttl
+        # path -> {variant: (expires, body)}, and the (path, variant) pairs least recently used
+        # first: size bounds the bodies, however many variants a path has
+        self.entries = {}
+        self.order = OrderedDict()
+
+    async def get(self, path, variant):
+        expires, body = self.entries.get(path, {}).get(variant, (0, None))
+        if body is not None and expires < monotonic():
+            self.discard(path, variant)
+            body = None
+        if body is None:
+            self.misses += 1
+            return None
+        self.order.move_to_end((path, variant))
+        self.hits += 1
+        return body
+
+    async def set(self, path, variant, body):
+        self.entries.setdefault(path, {})[variant] = (monotonic() + self.ttl, body)
+        self.order[(path, variant)] = None
+        self.order.move_to_end((path, variant))
+        while len(self.order) > self.size:
+            self.discard(*next(iter(self.order)))
+
+    def discard(self, path, variant):
+        del self.order[(path, variant)]
+        variants = self.entries[path]
+        del variants[variant]
+        if not variants:
+            del self.entries[path]
+
+    def drop(self, path):
+        for variant in self.entries.pop(path, {}):
+            del self.order[(path, variant)]
+
+    async def invalidate(self, path, descendants=True):
+        for key in ancestors(path):
+            self.drop(key)
+        if descendants:
+            prefix = path.rstrip("/") + "/"
+            for key in [key for key in self.entries if key.startswith(prefix)]:
+                self.drop(key)
+
+    async def clear(self):
+        self.entries.clear()
+        self.order.clear()
+
+    def stats(self):
+        return {**super().stats(), "size": len(self.order)}
+
+
+class RedisCache(Cache):
+    backend = "redis"
+
+    def __init__(self, url, ttl, variants, prefix="ylab:"):
+        super().__init__()
+        # Optional dependency, only needed when CACHE_BACKEND=redis
+        from redis.asyncio import from_url
+        self.redis = from_url(url)
+        self.ttl = ttl
+        self.variants = variants
+        self.prefix = prefix
+
+    async def get(self, path, variant):
+        body = await self.redis.hget(self.prefix + path, variant)
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    async def set(self, path, variant, body):
+        # A path's hash expires ttl after its first variant, later ones don't push that back. One
+        # with more than `variants` of them starts over with the newest.
+        key = self.prefix + path
+        async with self.redis.pipeline(transaction=False) as pipe:
+            _, count, ttl = await pipe.hset(key, variant, body).hlen(key).ttl(key).execute()
+        if count > self.variants:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                await pipe.delete(key).hset(key, variant, body).expire(key, self.ttl).execute()
+        elif ttl < 0:
+            await self.redis.expire(key, self.ttl)
+
+    async def invalidate(self, path, descendants=True):
+        keys = [self.prefix + key for key in ancestors(path)]
+        if descendants:
+            keys += [key async for key in self.redis.scan_iter(match=f"{self.prefix}{path.rstrip('/')}/*")]
+        await self.redis.delete(*keys)
+
+    async def clear(self):
+        keys = [key async for key in self.redis.scan_iter(match=f"{self.prefix}*")]
+        if keys:
+            await self.redis.delete(*keys)
+
+
+def create_cache():
+    backend = environ.get("CACHE_BACKEND", "memory")
+    ttl = int(environ.get("CACHE_TTL", 60))
+    if replica_settings and read_your_writes:
+        # Bodies are read from a replica, which may lag behind a write that just invalidated them.
+        # They live no longer than the writer keeps bypassing the cache for the primary.
+        ttl = min(ttl, read_your_writes)
+    if backend == "memory":
+        return MemoryCache(int(environ.get("CACHE_SIZE", 1024)), ttl)
+    if backend == "redis":
+        return RedisCache(environ.get("REDIS_URL", "redis://localhost:6379/0"), ttl,
+                          int(environ.get("CACHE_VARIANTS", 64)))
+    if backend == "none":
+        return Cache()
+    raise ValueError(f"unknown CACHE_BACKEND {backend!r}, expected 'memory', 'redis' or 'none'")
+
+
+cache = create_cache()
+
+
+def render(content):
+    # Same encoding as FastAPI's ORJSONResponse so cached and fresh bodies are byte-identical
+    return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def key(request: Request):
+    # The path as routed, whether the tenant came in the path prefix or the header
+    return f"/{request.state.tenant}{request.scope['path']}"
+
+
+def variant(request: Request):
+    return urlencode(sorted((name, value) for name, value in request.query_params.multi_items() if name in PARAMS))
+
+
+def pack(body, headers):
+    # Response headers (pagination links) travel with the body on one line in front of it
+    return dumps(headers).encode("utf-8") + b"\n" + body
+
+
+def unpack(value):
+    headers, body = value.split(b"\n", 1)
+    return body, loads(headers)
+
+
+def not_modified(request: Request, etag):
+    # If-None-Match holds one or more (possibly weak) tags or *, compared weakly as for GET
+    tags = [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]
+    return "*" in tags or etag in tags
+
+
+async def lookup(request: Request):
+    # A client that just wrote reads its write from the primary, not from a body cached before it
+    if PRIMARY_COOKIE in request.cookies:
+        return None
+    value = await cache.get(key(request), variant(request))
+    if value is not None:
+        body, headers = unpack(value)
+        if "ETag" in headers and not_modified(request, headers["ETag"]):
+            return Response(status_code=304, headers={"ETag": headers["ETag"]})
+        return Response(body, headers=headers, media_type="application/json")
+
+
+def encode(content):
+    # content may already be an encoded JSON body, e.g. built by Postgres
+    if isinstance(content, bytes):
+        return content
+    started = perf_counter()
+    body = render(content)
+    serialization.observe(perf_counter() - started)
+    return body
+
+
+async def store(request: Request, content, headers=None):
+    body = encode(content)
+    if PRIMARY_COOKIE not in request.cookies:
+        await cache.set(key(request), variant(request), pack(body, headers or {}))
+    return Response(body, headers=headers, media_type="application/json")
@@ -0,0 +1,122 @@
+from asyncio import Event, Queue, QueueFull, TimeoutError, create_task, gather, sleep, wait_for
+from collections import deque
+from logging import getLogger
+from os import environ
+from orjson import loads
+from db.dbconnection import listen
+
+# One LISTEN connection per process fans the change events out to every SSE subscriber of the
+# event's tenant, so idle subscribers cost nothing but their queue. The last events are kept for
+# clients that reconnect with Last-Event-ID; older tokens get a reset event and should reload.
+CHANNEL = "ylab_changes"
+RESET = b"event: reset\ndata: {}\n\n"
+KEEPALIVE = b": keepalive\n\n"
+buffer_size = int(environ.get('CHANGES_BUFFER', 1000))
+queue_size = int(environ.get('CHANGES_QUEUE', 100))
+keepalive = float(environ.get('CHANGES_KEEPALIVE', 15))
+retry = float(environ.get('CHANGES_RETRY', 2))
+log = getLogger("app.changes")
+
+events = deque(maxlen=buffer_size)
+subscribers = {}
+listener = None
+listening = None
+
+
+def end(queue):
+    # None ends the subscriber's stream
+    subscribers.pop(queue, None)
+    while not queue.empty():
+        queue.get_nowait()
+    queue.put_nowait(None)
+
+
+def broadcast(chunk, tenant=None):
+    # None reaches every tenant's subscribers
+    for queue, subscriber in list(subscribers.items()):
+        if tenant is not None and subscriber != tenant:
+            continue
+        try:
+            queue.put_nowait(chunk)
+        except QueueFull:
+            # A client that stopped reading is let go, it comes back with its Last-Event-ID
+            end(queue)
+
+
+def publish(payload):
+    event = loads(payload)
+    chunk = f"id: {event['event']}\nevent: change\ndata: {payload}\n\n".encode("utf-8")
+    events.append((event["event"], event["tenant"], chunk))
+    broadcast(chunk, event["tenant"])
+
+
+async def run():
+    reconnect = False
+
+    def ready():
+        if reconnect:
+            # Whatever was sent while we were away is lost, subscribers have to reload
+            events.clear()
+            broadcast(RESET)
+        listening.set()
+
+    while True:
+        try:
+            await listen(CHANNEL, publish, ready, keepalive * 2)
+        except Exception as error:
+            log.warning("listening on %s failed: %r", CHANNEL, error)
+        listening.clear()
+        reconnect = True
+        await sleep(retry)
+
+
+async def start(timeout=10):
+    # False when the listener could not get its connection in time
+    global listener, listening
+    if listener is None:
+        listening = Event()
+        listener = create_task(run())
+    try:
+        await wait_for(listening.wait(), timeout)
+    except TimeoutError:
+        return False
+    return True
+
+
+async def stop():
+    global listener
+    if listener is not None:
+        listener.cancel()
+        await gather(listener, return_exceptions=True)
+        listener = None
+    events.clear()
+    for queue in list(subscribers):
+        end(queue)
+
+
+def subscribe(tenant, last_event_id=None):
+    # Returns the subscriber's queue and the tenant's events it missed since last_event_id
+    queue = Queue(queue_size)
+    subscribers[queue] = tenant
+    if last_event_id is None:
+        return queue, []
+    for position, (event_id, _, _) in enumerate(events):
+        if event_id == last_event_id:
+            return queue, [chunk for _, owner, chunk in list(events)[position + 1:] if owner == tenant]
+    return queue, [RESET]
+
+
+async def stream(queue, backlog):
+    try:
+        for chunk in backlog:
+            yield chunk
+        while True:
+            try:
+                chunk = await wait_for(queue.get(), keepalive)
+            except TimeoutError:
+                chunk = KEEPALIVE
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        subscribers.pop(queue, None)
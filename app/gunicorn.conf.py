@@ -0,0 +1,23 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+
+from dotenv import load_dotenv
+from multiprocessing import cpu_count
+from os import environ, path
+
+# gunicorn -c app/gunicorn.conf.py app.api:app
+dotenv_path = path.join(path.dirname(__file__), '../.env')
+if path.exists(dotenv_path):
+    load_dotenv(dotenv_path)
+
+bind = f"{environ.get('WSGI_HOST', '0.0.0.0')}:{environ.get('WSGI_PORT', 8000)}"
+workers = int(environ.get('WSGI_WORKERS') or cpu_count())
+worker_class = "uvicorn.workers.UvicornWorker"
+
+
+def on_starting(server):
+    # Runs once in the master before any worker is forked, the workers then skip migrations
+    from app.api import check_workers, migrate_once
+    check_workers(server.cfg.workers)
+    migrate_once()
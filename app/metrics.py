@@ -0,0 +1,107 @@
+from time import perf_counter
+from app import admission
+from db import stats
+from db.stats import Histogram
+
+# Prometheus text exposition without the client library: a handful of dicts updated on the
+# event loop and rendered on demand. Routes are labelled by their template, never the raw path.
+requests = {}
+serialization = Histogram()
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware, it times the request until the last body chunk is sent, so
+    # streamed responses are measured whole
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            key = (scope["method"], route.path if route is not None else "unmatched")
+            entry = requests.get(key)
+            if entry is None:
+                entry = requests[key] = {"duration": Histogram(), "statuses": {}}
+            entry["duration"].observe(perf_counter() - started)
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(**values):
+    return ",".join(f'{name}="{escape(value)}"' for name, value in values.items())
+
+
+def histogram(lines, name, histogram, **values):
+    prefix = labels(**values) + "," if values else ""
+    for bound, count in histogram.cumulative():
+        lines.append(f'{name}_bucket{{{prefix}le="{"+Inf" if bound == float("inf") else bound}"}} {count}')
+    suffix = "{" + labels(**values) + "}" if values else ""
+    lines.append(f"{name}_sum{suffix} {histogram.sum}")
+    lines.append(f"{name}_count{suffix} {histogram.count}")
+
+
+def exposition(cache_stats):
+    lines = ["# HELP http_requests_total Requests by route template and status",
+             "# TYPE http_requests_total counter"]
+    for (method, route), entry in requests.items():
+        for status, count in entry["statuses"].items():
+            lines.append(f"http_requests_total{{{labels(method=method, route=route, status=status)}}} {count}")
+    lines += ["# HELP http_request_duration_seconds Time from the request to the last body chunk",
+              "# TYPE http_request_duration_seconds histogram"]
+    for (method, route), entry in requests.items():
+        histogram(lines, "http_request_duration_seconds", entry["duration"], method=method, route=route)
+    lines += ["# HELP http_serialization_seconds Time spent encoding JSON bodies",
+              "# TYPE http_serialization_seconds histogram"]
+    histogram(lines, "http_serialization_seconds", serialization)
+    lines += ["# HELP db_query_duration_seconds Statement execution time",
+              "# TYPE db_query_duration_seconds histogram"]
+    for name, statement in stats.statements.items():
+        histogram(lines, "db_query_duration_seconds", statement.duration, query=name)
+    lines += ["# HELP db_query_rows_total Rows returned or affected by statement",
+              "# TYPE db_query_rows_total counter"]
+    for name, statement in stats.statements.items():
+        lines.append(f"db_query_rows_total{{{labels(query=name)}}} {statement.rows}")
+    lines += ["# HELP db_pool_wait_seconds Time spent waiting for a pooled connection",
+              "# TYPE db_pool_wait_seconds histogram"]
+    histogram(lines, "db_pool_wait_seconds", stats.pool_wait)
+    lines += ["# HELP admission_active_requests Requests holding an admission slot",
+              "# TYPE admission_active_requests gauge"]
+    for name, limiter in admission.limiters.items():
+        lines.append(f"admission_active_requests{{{labels(kind=name)}}} {limiter.active}")
+    lines += ["# HELP admission_queued_requests Requests waiting for an admission slot",
+              "# TYPE admission_queued_requests gauge"]
+    for name, limiter in admission.limiters.items():
+        lines.append(f"admission_queued_requests{{{labels(kind=name)}}} {len(limiter.waiters)}")
+    lines += ["# HELP admission_rejected_total Requests answered 503 because the queue was full or the wait too long",
+              "# TYPE admission_rejected_total counter"]
+    for name, limiter in admission.limiters.items():
+        for reason, count in limiter.rejected.items():
+            lines.append(f"admission_rejected_total{{{labels(kind=name, reason=reason)}}} {count}")
+    lines += ["# HELP admission_wait_seconds Time queued requests waited for a slot",
+              "# TYPE admission_wait_seconds histogram"]
+    for name, limiter in admission.limiters.items():
+        histogram(lines, "admission_wait_seconds", limiter.wait, kind=name)
+    lines += ["# HELP rate_limited_total Requests answered 429 by the per-client rate limit",
+              "# TYPE rate_limited_total counter",
+              f"rate_limited_total {admission.rate_limiter.limited if admission.rate_limiter else 0}"]
+    lines += ["# HELP cache_hits_total Response cache hits", "# TYPE cache_hits_total counter",
+              f"cache_hits_total{{{labels(backend=cache_stats['backend'])}}} {cache_stats['hits']}",
+              "# HELP cache_misses_total Response cache misses", "# TYPE cache_misses_total counter",
+              f"cache_misses_total{{{labels(backend=cache_stats['backend'])}}} {cache_stats['misses']}"]
+    return "\n".join(lines) + "\n"
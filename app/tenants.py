@@ -0,0 +1,41 @@
+from re import fullmatch
+from fastapi.responses import ORJSONResponse
+from starlette.datastructures import Headers
+from db.settings import default_tenant
+
+# Every request belongs to one tenant (restaurant), named by a /t/<tenant> prefix in front of the
+# API paths or by the X-Tenant header; requests naming neither get TENANT_DEFAULT. The prefix
+# moves to root_path, so routing, admission and metrics see the plain /api/v1 paths while the
+# links built from request.url keep it.
+PREFIX = "/t/"
+PATTERN = r"[a-z0-9][a-z0-9_-]{0,62}"
+
+
+class TenantMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if scope["path"].startswith(PREFIX):
+            tenant, _, path = scope["path"][len(PREFIX):].partition("/")
+            scope["root_path"] = scope.get("root_path", "") + PREFIX + tenant
+            scope["path"] = "/" + path
+            vary = False
+        else:
+            tenant = Headers(scope=scope).get("x-tenant") or default_tenant
+            vary = True
+        if not tenant:
+            return await ORJSONResponse({"detail": "tenant required"}, status_code=400)(scope, receive, send)
+        if not fullmatch(PATTERN, tenant):
+            return await ORJSONResponse({"detail": "invalid tenant"}, status_code=400)(scope, receive, send)
+        scope.setdefault("state", {})["tenant"] = tenant
+
+        async def send_wrapper(message):
+            # The same URL answers for every tenant, shared caches must keep them apart
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"vary", b"X-Tenant")]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper if vary else send)
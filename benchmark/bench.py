@@ -0,0 +1,250 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+
+from argparse import ArgumentParser
+from asyncio import gather, run, sleep
+from datetime import datetime, timezone
+from json import dump, load as load_json
+from os import environ
+from random import Random
+from subprocess import DEVNULL, CalledProcessError, Popen, check_output
+from time import perf_counter
+from httpx import AsyncClient, HTTPError, Limits
+
+# Benchmarks always run against the test database, never the one in POSTGRES_HOST
+environ["TEST"] = "True"
+from db.bulk import load
+from db.dbconnection import close, database
+from db.migrate import migrate
+from db.settings import default_tenant
+
+# Upper bounds of the latency histogram buckets in milliseconds, the last one catches the rest
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf")]
+MENUS = "/api/v1/menus"
+
+
+def ids(args, rng):
+    # Seeding restarts the sequences, so menu m owns submenus and dishes in contiguous id ranges
+    menu = rng.randint(1, args.menus)
+    submenu = (menu - 1) * args.submenus + rng.randint(1, args.submenus)
+    dish = (submenu - 1) * args.dishes + rng.randint(1, args.dishes)
+    return menu, submenu, dish
+
+
+def dish_body(rng):
+    return {"title": f"Dish {rng.random()}", "description": "Benchmark dish", "price": "12.50"}
+
+
+# name: (method, path, body), paths are filled from ids() so every request hits an existing row
+ROUTES = {
+    "get_menus": lambda m, s, d, rng: ("GET", MENUS, None),
+    "get_menu": lambda m, s, d, rng: ("GET", f"{MENUS}/{m}", None),
+    "get_menu_tree": lambda m, s, d, rng: ("GET", f"{MENUS}/{m}/tree", None),
+    "get_submenus": lambda m, s, d, rng: ("GET", f"{MENUS}/{m}/submenus", None),
+    "get_submenu": lambda m, s, d, rng: ("GET", f"{MENUS}/{m}/submenus/{s}", None),
+    "get_dishes": lambda m, s, d, rng: ("GET", f"{MENUS}/{m}/submenus/{s}/dishes", None),
+    "get_dish": lambda m, s, d, rng: ("GET", f"{MENUS}/{m}/submenus/{s}/dishes/{d}", None),
+    "create_dish": lambda m, s, d, rng: ("POST", f"{MENUS}/{m}/submenus/{s}/dishes", dish_body(rng)),
+    "update_dish": lambda m, s, d, rng: ("PATCH", f"{MENUS}/{m}/submenus/{s}/dishes/{d}", dish_body(rng)),
+    "get_tree": lambda m, s, d, rng: ("GET", f"{MENUS}/tree", None),
+}
+# The full tree and export scale with the whole dataset, they are opt-in through --routes
+DEFAULT_ROUTES = [name for name in ROUTES if name != "get_tree"]
+
+
+def dataset(first, count, submenus, dishes):
+    return [{"title": f"Menu {m}", "description": f"Menu {m} description", "submenus": [
+        {"title": f"Submenu {m}.{s}", "description": f"Submenu {m}.{s} description", "dishes": [
+            {"title": f"Dish {m}.{s}.{d}", "description": f"Dish {m}.{s}.{d} description", "price": f"{d}.99"}
+            for d in range(1, dishes + 1)]}
+        for s in range(1, submenus + 1)]}
+        for m in range(first, first + count)]
+
+
+async def seed(args, batch=20):
+    # Loaded a few menus per transaction so a million dishes never sit in memory at once
+    await migrate()
+    async with database() as db:
+        await db.execute("TRUNCATE menus, submenus, dishes RESTART IDENTITY")
+        for first in range(1, args.menus + 1, batch):
+            await load(db, dataset(first, min(batch, args.menus - first + 1), args.submenus, args.dishes),
+                       default_tenant)
+        await db.execute("ANALYZE menus, submenus, dishes")
+    await close()
+
+
+def percentile(latencies, fraction):
+    # Nearest-rank on the sorted latencies
+    return latencies[min(len(latencies) - 1, max(0, round(fraction * len(latencies)) - 1))]
+
+
+def bucket(bound):
+    return f"le_{bound:g}ms" if bound != float("inf") else "le_inf"
+
+
+def summarize(latencies, errors, elapsed):
+    latencies.sort()
+    histogram = dict.fromkeys(map(bucket, BUCKETS), 0)
+    position = 0
+    for latency in latencies:
+        while latency > BUCKETS[position]:
+            position += 1
+        histogram[bucket(BUCKETS[position])] += 1
+    result = {"requests": len(latencies), "errors": errors, "seconds": round(elapsed, 3),
+              "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0}
+    if latencies:
+        result["latency_ms"] = {"min": round(latencies[0], 3),
+                                "mean": round(sum(latencies) / len(latencies), 3),
+                                "p50": round(percentile(latencies, 0.50), 3),
+                                "p90": round(percentile(latencies, 0.90), 3),
+                                "p99": round(percentile(latencies, 0.99), 3),
+                                "max": round(latencies[-1], 3)}
+    result["histogram"] = histogram
+    return result
+
+
+async def drive(client, args, route, requests, seed_value):
+    # requests are shared out between args.concurrency clients, each on its own keep-alive connection
+    latencies, errors = [], 0
+    remaining = [requests]
+
+    async def worker(number):
+        nonlocal errors
+        rng = Random(seed_value * 1000 + number)
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            method, url, body = ROUTES[route](*ids(args, rng), rng)
+            started = perf_counter()
+            try:
+                response = await client.request(method, url, json=body)
+                await response.aread()
+                ok = response.status_code < 400
+            except HTTPError:
+                ok = False
+            if ok:
+                latencies.append((perf_counter() - started) * 1000)
+            else:
+                errors += 1
+
+    started = perf_counter()
+    await gather(*(worker(number) for number in range(args.concurrency)))
+    return latencies, errors, perf_counter() - started
+
+
+async def wait_ready(client, timeout=30):
+    for _ in range(int(timeout * 10)):
+        try:
+            if (await client.get("/api/v1/cache")).status_code == 200:
+                return
+        except HTTPError:
+            pass
+        await sleep(0.1)
+    raise SystemExit("the API did not come up")
+
+
+async def benchmark(args):
+    limits = Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = {}
+    async with AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        await wait_ready(client)
+        for number, route in enumerate(args.routes):
+            await drive(client, args, route, args.warmup, number)
+            latencies, errors, elapsed = await drive(client, args, route, args.requests, number + 100)
+            results[route] = summarize(latencies, errors, elapsed)
+            print(f"{route:15} {results[route]['rps']:>9} rps  "
+                  f"p50 {results[route].get('latency_ms', {}).get('p50', '-')} ms  "
+                  f"p99 {results[route].get('latency_ms', {}).get('p99', '-')} ms  "
+                  f"errors {errors}", file=sys.stderr)
+    return results
+
+
+def revision():
+    try:
+        return check_output(["git", "rev-parse", "--short", "HEAD"], stderr=DEVNULL, text=True).strip()
+    except (OSError, CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    # Relative change per route, positive rps and negative p99 are improvements
+    with open(old_path, encoding="utf-8") as file:
+        old = load_json(file)
+    with open(new_path, encoding="utf-8") as file:
+        new = load_json(file)
+    print(f"{'route':15} {'rps':>22} {'p99 ms':>24}")
+    for route, result in new["routes"].items():
+        before = old["routes"].get(route)
+        if before is None or "latency_ms" not in before or "latency_ms" not in result:
+            print(f"{route:15} {'n/a':>22} {'n/a':>24}")
+            continue
+        rps = f"{before['rps']} -> {result['rps']} ({(result['rps'] / before['rps'] - 1) * 100:+.1f}%)" \
+            if before["rps"] else f"{before['rps']} -> {result['rps']}"
+        p99_before, p99_after = before["latency_ms"]["p99"], result["latency_ms"]["p99"]
+        p99 = f"{p99_before} -> {p99_after} ({(p99_after / p99_before - 1) * 100:+.1f}%)" \
+            if p99_before else f"{p99_before} -> {p99_after}"
+        print(f"{route:15} {rps:>22} {p99:>24}")
+
+
+def main():
+    parser = ArgumentParser(description="Seed the test database, drive the API routes and report a JSON baseline")
+    parser.add_argument("--menus", type=int, default=1000)
+    parser.add_argument("--submenus", type=int, default=20, help="per menu")
+    parser.add_argument("--dishes", type=int, default=50, help="per submenu")
+    parser.add_argument("--no-seed", action="store_true", help="reuse data seeded with the same sizes")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000, help="per route")
+    parser.add_argument("--warmup", type=int, default=100, help="per route, not recorded")
+    parser.add_argument("--routes", default=",".join(DEFAULT_ROUTES), help=f"any of {', '.join(ROUTES)}")
+    parser.add_argument("--url", help="benchmark a running API instead of starting one")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--cache", default="none", help="CACHE_BACKEND of the started API")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="print the change between two results")
+    args = parser.parse_args()
+    if args.compare:
+        return compare(*args.compare)
+    args.routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    unknown = [route for route in args.routes if route not in ROUTES]
+    if unknown:
+        raise SystemExit(f"unknown routes: {', '.join(unknown)}")
+
+    if not args.no_seed:
+        started = perf_counter()
+        run(seed(args))
+        print(f"Seeded {args.menus} menus x {args.submenus} submenus x {args.dishes} dishes "
+              f"in {perf_counter() - started:.1f}s", file=sys.stderr)
+
+    server = None
+    if args.url is None:
+        args.url = f"http://127.0.0.1:{args.port}"
+        server = Popen([sys.executable, "-m", "uvicorn", "app.api:app", "--host", "127.0.0.1",
+                        "--port", str(args.port), "--log-level", "warning", "--no-access-log"],
+                       env={**environ, "CACHE_BACKEND": args.cache})
+    try:
+        results = run(benchmark(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {"meta": {"revision": revision(),
+                       "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                       "python": sys.version.split()[0],
+                       "engine": environ.get("DB_ENGINE", "sync"),
+                       "cache": args.cache if server is not None else None,
+                       "dataset": {"menus": args.menus, "submenus": args.submenus, "dishes": args.dishes},
+                       "concurrency": args.concurrency, "requests": args.requests, "warmup": args.warmup},
+              "routes": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            dump(report, file, indent=2)
+    else:
+        dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    # python benchmark/bench.py --menus 1000 --submenus 20 --dishes 50 --output baseline.json
+    # python benchmark/bench.py --compare baseline.json current.json
+    main()
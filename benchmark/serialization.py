@@ -0,0 +1,85 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+
+from anyio import run
+from argparse import ArgumentParser
+from fastapi.encoders import jsonable_encoder
+from json import dump, dumps
+from os import environ
+from time import perf_counter, process_time
+
+# Benchmarks always run against the test database, never the one in POSTGRES_HOST
+environ["TEST"] = "True"
+from app.cache import render
+from db.bulk import load
+from db.dbconnection import close, database
+from db.migrate import migrate
+from db.queries import GET_DISHES
+from db.settings import default_tenant
+
+
+def stdlib(rows, names):
+    # What the handlers did before: dicts, FastAPI's jsonable_encoder and the json module
+    content = jsonable_encoder([dict(zip(names, row)) for row in rows])
+    return dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def python(rows, names):
+    return render([dict(zip(names, row)) for row in rows])
+
+
+async def measure(args):
+    names = list(GET_DISHES.columns)
+    results = {}
+    async with database() as db:
+        await db.execute("TRUNCATE menus, submenus, dishes RESTART IDENTITY")
+        await load(db, [{"title": "Menu", "description": "Serialization benchmark", "submenus": [
+            {"title": "Submenu", "description": "Serialization benchmark", "dishes": [
+                {"title": f"Dish {number}", "description": f"Dish {number} description", "price": f"{number}.99"}
+                for number in range(args.rows)]}]}], default_tenant)
+        select, select_json = GET_DISHES.select(names), GET_DISHES.select_json(names)
+        paths = {
+            "stdlib": lambda: db.fetch(select, default_tenant, 1, 1, None, None, 0, args.rows + 1),
+            "orjson": lambda: db.fetch(select, default_tenant, 1, 1, None, None, 0, args.rows + 1),
+            "postgres": lambda: db.fetchrow(select_json, default_tenant, 1, 1, None, None, 0, args.rows + 1),
+        }
+        encode = {"stdlib": lambda rows: stdlib(rows, names),
+                  "orjson": lambda rows: python(rows, names),
+                  "postgres": lambda row: row[0].encode("utf-8")}
+        for path, fetch in paths.items():
+            await fetch()
+            cpu = wall = encoding = 0.0
+            for _ in range(args.repeat):
+                started_cpu, started_wall = process_time(), perf_counter()
+                rows = await fetch()
+                started_encoding = process_time()
+                body = encode[path](rows)
+                encoding += process_time() - started_encoding
+                cpu += process_time() - started_cpu
+                wall += perf_counter() - started_wall
+            scale = 10000 / args.rows / args.repeat * 1000
+            results[path] = {"cpu_ms_per_10k_rows": round(cpu * scale, 2),
+                             "encode_cpu_ms_per_10k_rows": round(encoding * scale, 2),
+                             "wall_ms_per_10k_rows": round(wall * scale, 2),
+                             "bytes": len(body)}
+    return results
+
+
+async def main(args):
+    try:
+        await migrate()
+        return await measure(args)
+    finally:
+        await close()
+
+
+if __name__ == "__main__":
+    # python benchmark/serialization.py --rows 10000 --repeat 20
+    # CPU is this process only (driver, dicts, encoding); Postgres' share shows in the wall time
+    parser = ArgumentParser(description="CPU spent turning a page of rows into a JSON body, per path")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    results = run(main, parser.parse_args())
+    dump(results, sys.stdout, indent=2)
+    print()
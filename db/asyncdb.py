@@ -0,0 +1,193 @@
+from asyncio import Lock, Queue, TimeoutError, create_task, sleep
+from asyncpg import PostgresError, connect, create_pool
+from contextlib import asynccontextmanager
+from os import register_at_fork
+from time import perf_counter
+from db import stats
+from db.queries import Query
+from db.router import Router
+from db.settings import db_settings, pool_settings, pool_timeout, replica_settings, replica_timeout
+
+class Pool:
+    # One per server. asyncpg pools are bound to the running event loop, so they are opened
+    # on first use
+    def __init__(self, settings):
+        self.settings = settings
+        self.pool = None
+        self.lock = None
+
+    async def get(self):
+        if self.pool is None:
+            self.lock = self.lock or Lock()
+            async with self.lock:
+                if self.pool is None:
+                    self.pool = await create_pool(min_size=pool_settings["minconn"],
+                                                  max_size=pool_settings["maxconn"],
+                                                  **self.settings)
+        return self.pool
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool, self.lock = None, None
+
+    def forget(self):
+        # The parent's pool belongs to its event loop and sockets, a forked worker opens its own
+        if self.pool is not None:
+            inherited.append(self.pool)
+        self.pool, self.lock = None, None
+
+
+# Database
+primary = Pool(db_settings)
+router = Router([Pool({**settings, "timeout": replica_timeout}) for settings in replica_settings])
+inherited = []
+
+
+def forget_pools():
+    for pool in [primary, *router.replicas]:
+        pool.forget()
+
+
+register_at_fork(after_in_child=forget_pools)
+
+
+def count(status):
+    number = status.rsplit(" ", 1)[-1]
+    return int(number) if number.isdigit() else -1
+
+
+def statement(query):
+    # asyncpg prepares every parameterized statement through its per-connection cache, keyed
+    # by the SQL text, so a Query only has to hand over its text
+    return query.sql if isinstance(query, Query) else query
+
+
+class Database:
+    # The connection is acquired on the first query, so requests answered without the
+    # database (e.g. from the cache) never wait on the pool. Read-only ones try the replicas.
+    def __init__(self, read=False):
+        self.read = read
+        self.pool = None
+        self.connection = None
+
+    async def connect(self):
+        if self.connection is None:
+            started = perf_counter()
+            for pool in router.candidates() if self.read else []:
+                try:
+                    replica = await pool.get()
+                except (OSError, TimeoutError, PostgresError):
+                    router.down(pool)
+                    continue
+                try:
+                    self.connection = await replica.acquire(timeout=pool_timeout)
+                    self.pool = replica
+                    break
+                except TimeoutError:
+                    pass
+                except (OSError, PostgresError):
+                    router.down(pool)
+            if self.connection is None:
+                self.pool = await primary.get()
+                self.connection = await self.pool.acquire(timeout=pool_timeout)
+            stats.pool_wait.observe(perf_counter() - started)
+        return self.connection
+
+    async def release(self):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            await self.pool.release(connection)
+
+    async def timed(self, method, query, args, rows):
+        connection = await self.connect()
+        started = perf_counter()
+        value = await getattr(connection, method)(statement(query), *args)
+        stats.observe(query, args, perf_counter() - started, rows(value))
+        return value
+
+    async def fetch(self, query, *args):
+        return await self.timed("fetch", query, args, len)
+
+    async def fetchrow(self, query, *args):
+        return await self.timed("fetchrow", query, args, lambda row: int(row is not None))
+
+    async def fetchval(self, query, *args):
+        return await self.timed("fetchval", query, args, lambda value: int(value is not None))
+
+    async def execute(self, query, *args):
+        # asyncpg returns the command tag, e.g. "DELETE 3"
+        status = await self.timed("execute", query, args, count)
+        return count(status)
+
+    async def iterate(self, query, *args, size=500):
+        # Server-side cursor, rows are pulled in batches instead of materializing the result
+        async with self.transaction():
+            started, rows = perf_counter(), 0
+            try:
+                async for row in self.connection.cursor(query, *args, prefetch=size):
+                    rows += 1
+                    yield row
+            finally:
+                # Includes the time the consumer spent between batches
+                stats.observe(query, args, perf_counter() - started, rows)
+
+    async def copy_records(self, table, columns, records):
+        await (await self.connect()).copy_records_to_table(table, records=records, columns=columns)
+
+    async def copy_csv(self, query, *args, queue_size=16):
+        # COPY (query) TO STDOUT feeds a bounded queue, so a slow client pauses the export
+        connection = await self.connect()
+        chunks = Queue(queue_size)
+
+        async def produce():
+            try:
+                await connection.copy_from_query(query, *args, output=chunks.put, format="csv", header=True)
+            finally:
+                await chunks.put(None)
+
+        producer = create_task(produce())
+        try:
+            while (chunk := await chunks.get()) is not None:
+                yield bytes(chunk)
+            await producer
+        finally:
+            producer.cancel()
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with (await self.connect()).transaction():
+            yield self
+
+
+@asynccontextmanager
+async def database(read=False):
+    db = Database(read)
+    try:
+        yield db
+    finally:
+        await db.release()
+
+
+async def get_db():
+    async with database() as db:
+        yield db
+
+
+async def listen(channel, callback, ready, keepalive=30):
+    # Own connection outside the pool, callback(payload) runs on the event loop for every
+    # notification. Returns only by raising once the connection is lost.
+    connection = await connect(**db_settings)
+    try:
+        await connection.add_listener(channel, lambda connection, pid, channel, payload: callback(payload))
+        ready()
+        while True:
+            await sleep(keepalive)
+            await connection.fetchval("SELECT 1")
+    finally:
+        connection.terminate()
+
+
+async def close():
+    for pool in [primary, *router.replicas]:
+        await pool.close()
@@ -0,0 +1,128 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+
+from anyio import run
+from csv import DictReader
+from decimal import Decimal
+from io import StringIO
+from json import loads
+from db.dbconnection import close, database
+from db.queries import EXPORT, GET_MENUS_TREE, NOTIFY_IMPORT
+from db.settings import default_tenant
+
+# Menus come as [{"title", "description", "submenus": [{"title", "description", "dishes": [...]}]}]
+# and are loaded into or exported from one tenant
+
+
+def price(value):
+    # Prices arrive as strings from files. They get the API's check for the NUMERIC(10, 2) column,
+    # at most 8 digits before the point and 2 after, rather than being rounded or overflowing.
+    if value is None or value == "":
+        return None
+    number = Decimal(str(value))
+    digits, exponent = number.as_tuple()[1:]
+    if not number.is_finite() or exponent < -2 or len(digits) + exponent > 8:
+        raise ValueError(f"price {value!r} is not a number with at most 8 digits and 2 decimal places")
+    return number
+
+
+def varchar(value):
+    # Titles and descriptions are VARCHAR(150), as the API's models check
+    if value is not None and len(value) > 150:
+        raise ValueError(f"{value[:20]!r}... is longer than 150 characters")
+    return value
+
+
+def parse_csv(text):
+    # One row per dish in the export layout. Rows are grouped by menu_id/submenu_id when the
+    # file has them, otherwise by title and description; empty submenu/dish columns mean none.
+    menus, submenus = {}, {}
+    for row in DictReader(StringIO(text)):
+        menu_key = row.get("menu_id") or (row["menu_title"], row.get("menu_description"))
+        if menu_key not in menus:
+            menus[menu_key] = {"title": varchar(row["menu_title"]), "description": varchar(row.get("menu_description")),
+                               "submenus": []}
+        if not (row.get("submenu_id") or row.get("submenu_title")):
+            continue
+        submenu_key = (menu_key, row.get("submenu_id") or (row["submenu_title"], row.get("submenu_description")))
+        if submenu_key not in submenus:
+            submenus[submenu_key] = {"title": varchar(row["submenu_title"]),
+                                     "description": varchar(row.get("submenu_description")), "dishes": []}
+            menus[menu_key]["submenus"].append(submenus[submenu_key])
+        if row.get("dish_id") or row.get("dish_title"):
+            submenus[submenu_key]["dishes"].append({"title": varchar(row["dish_title"]),
+                                                    "description": varchar(row.get("dish_description")),
+                                                    "price": price(row.get("dish_price"))})
+    return list(menus.values())
+
+
+async def allocate(db, sequence, count):
+    # Ids are drawn up front so children can be written with their parent ids in the same COPY
+    if not count:
+        return []
+    return [row[0] for row in await db.fetch(f"SELECT nextval('{sequence}') FROM generate_series(1, $1)", count)]
+
+
+async def load(db, menus, tenant):
+    submenus = [(menu_index, submenu) for menu_index, menu in enumerate(menus) for submenu in menu["submenus"]]
+    dishes = [(submenu_index, dish) for submenu_index, (_, submenu) in enumerate(submenus)
+              for dish in submenu["dishes"]]
+    async with db.transaction():
+        # Counters are written directly, the per-row triggers skip this transaction
+        await db.execute("SET LOCAL ylab.bulk_load = 'on'")
+        menu_ids = await allocate(db, "menus_id_seq", len(menus))
+        submenu_ids = await allocate(db, "submenus_id_seq", len(submenus))
+        dish_ids = await allocate(db, "dishes_id_seq", len(dishes))
+        await db.copy_records("menus", ["tenant", "id", "title", "description", "submenus_count", "dishes_count"], [
+            (tenant, menu_id, menu["title"], menu["description"], len(menu["submenus"]),
+             sum(len(submenu["dishes"]) for submenu in menu["submenus"]))
+            for menu_id, menu in zip(menu_ids, menus)])
+        await db.copy_records("submenus", ["tenant", "id", "menu", "title", "description", "dishes_count"], [
+            (tenant, submenu_id, menu_ids[menu_index], submenu["title"], submenu["description"], len(submenu["dishes"]))
+            for submenu_id, (menu_index, submenu) in zip(submenu_ids, submenus)])
+        await db.copy_records("dishes", ["tenant", "id", "submenu", "title", "description", "price"], [
+            (tenant, dish_id, submenu_ids[submenu_index], dish["title"], dish["description"], price(dish["price"]))
+            for dish_id, (submenu_index, dish) in zip(dish_ids, dishes)])
+        # Back on for whatever else an enclosing transaction does
+        await db.execute("SET LOCAL ylab.bulk_load = 'off'")
+        await db.fetchval(NOTIFY_IMPORT, tenant)
+    return {"menus": len(menus), "submenus": len(submenus), "dishes": len(dishes)}
+
+
+async def export_ndjson(db, tenant):
+    # One nested menu per line, built by Postgres and read through a server-side cursor
+    async for row in db.iterate(GET_MENUS_TREE, tenant):
+        yield (row[0] + "\n").encode("utf-8")
+
+
+def export_csv(db, tenant):
+    return db.copy_csv(EXPORT, tenant)
+
+
+async def main(command, target, tenant):
+    try:
+        async with database() as db:
+            if command == "import":
+                with open(target, encoding="utf-8") as file:
+                    text = file.read()
+                menus = parse_csv(text) if target.endswith(".csv") else loads(text)
+                counts = await load(db, menus, tenant)
+                print(f"Imported {counts['menus']} menus, {counts['submenus']} submenus and {counts['dishes']} dishes")
+            elif command == "export":
+                chunks = export_csv(db, tenant) if target == "csv" else export_ndjson(db, tenant)
+                async for chunk in chunks:
+                    sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+            else:
+                raise SystemExit(f"unknown command {command!r}, expected 'import' or 'export'")
+    finally:
+        await close()
+
+
+if __name__ == "__main__":
+    # python db/bulk.py import menus.json|menus.csv [tenant]
+    # python db/bulk.py export ndjson|csv [tenant] > dump
+    if len(sys.argv) not in (3, 4) or (len(sys.argv) == 3 and not default_tenant):
+        raise SystemExit("usage: python db/bulk.py import <file.json|file.csv> [tenant] | export <ndjson|csv> [tenant]")
+    run(main, sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else default_tenant)
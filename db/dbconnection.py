@@ -1,27 +1,10 @@
-from dotenv import load_dotenv
-from os import environ, path
-from psycopg2 import connect, OperationalError
-
-
-dotenv_path = path.abspath(path.join(path.dirname(__file__), '..', '.env'))
-if path.exists(dotenv_path):
-    load_dotenv(dotenv_path)
-
-
-if environ.get('TEST') == "False":
-    db_settings = {"database": environ.get('POSTGRES_TYPE'),
-                   "user": environ.get('POSTGRES_USER'),
-                   "password": environ.get('POSTGRES_PASSWORD'),
-                   "host": environ.get('POSTGRES_HOST'),
-                   "port": int(environ.get('POSTGRES_PORT'))}
+from db.settings import engine
+
+# Both engines expose the same coroutine API: fetch, fetchrow, fetchval, execute, iterate,
+# copy_records, copy_csv and transaction, plus listen for notifications
+if engine == "async":
+    from db.asyncdb import close, database, get_db, listen
+elif engine == "sync":
+    from db.syncdb import close, database, get_db, listen
 else:
-    db_settings = {"database": environ.get('POSTGRES_TEST_DB'),
-                   "user": environ.get('POSTGRES_USER'),
-                   "password": environ.get('POSTGRES_PASSWORD'),
-                   "host": environ.get('POSTGRES_TEST_HOST'),
-                   "port": int(environ.get('POSTGRES_TEST_PORT'))}
-
-# Database
-connection = connect(**db_settings)
-cursor = connection.cursor()
-
+    raise ValueError(f"unknown DB_ENGINE {engine!r}, expected 'sync' or 'async'")
@@ -0,0 +1,53 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+
+from anyio import run
+from os import listdir, path
+from db.dbconnection import close, database
+
+MIGRATIONS = path.join(path.dirname(__file__), 'migrations')
+# Any constant works, it only has to be the same in every process running migrations
+LOCK_ID = 7212023
+
+
+def migrations():
+    # Files are named <version>_<name>.sql and applied in version order
+    for filename in sorted(listdir(MIGRATIONS)):
+        if filename.endswith('.sql'):
+            version, name = filename[:-4].split('_', 1)
+            with open(path.join(MIGRATIONS, filename), encoding='utf-8') as file:
+                yield int(version), name, file.read()
+
+
+async def migrate():
+    applied = []
+    async with database() as db:
+        async with db.transaction():
+            # Concurrent starters queue here, the first applies and the rest find nothing to do
+            await db.execute("SELECT pg_advisory_xact_lock($1)", LOCK_ID)
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                name VARCHAR(150),
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now())
+            """)
+            done = {row[0] for row in await db.fetch("SELECT version FROM schema_migrations")}
+            for version, name, sql in migrations():
+                if version not in done:
+                    await db.execute(sql)
+                    await db.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+                    applied.append(f"{version:04d}_{name}")
+    return applied
+
+
+async def main():
+    try:
+        applied = await migrate()
+    finally:
+        await close()
+    print("Applied " + ", ".join(applied) if applied else "Schema is up to date")
+
+
+if __name__ == "__main__":
+    run(main)
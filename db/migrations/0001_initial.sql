@@ -0,0 +1,60 @@
+CREATE TABLE menus (
+    id SERIAL PRIMARY KEY,
+    title VARCHAR(150),
+    description VARCHAR(150),
+    submenus_count INT NOT NULL DEFAULT 0,
+    dishes_count INT NOT NULL DEFAULT 0);
+CREATE TABLE submenus (
+    id SERIAL PRIMARY KEY,
+    menu INT REFERENCES menus (id) ON DELETE CASCADE,
+    title VARCHAR(150), description VARCHAR(150),
+    dishes_count INT NOT NULL DEFAULT 0);
+CREATE TABLE dishes (
+    id SERIAL PRIMARY KEY,
+    submenu INT REFERENCES submenus (id) ON DELETE CASCADE,
+    title VARCHAR(150),
+    description VARCHAR(150),
+    price VARCHAR(150));
+
+-- Counters are maintained by row triggers, so cascaded deletes keep them right as well.
+-- A dish only touches its submenu; the submenu trigger then carries the delta to the menu.
+-- When a parent is deleted first its row is already gone and the child update is a no-op.
+CREATE OR REPLACE FUNCTION count_dishes() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND NEW.submenu IS NOT DISTINCT FROM OLD.submenu THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE submenus SET dishes_count = dishes_count + 1 WHERE id = NEW.submenu;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE submenus SET dishes_count = dishes_count - 1 WHERE id = OLD.submenu;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_submenus() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND NEW.menu IS NOT DISTINCT FROM OLD.menu THEN
+        IF NEW.dishes_count <> OLD.dishes_count THEN
+            UPDATE menus SET dishes_count = dishes_count + NEW.dishes_count - OLD.dishes_count WHERE id = NEW.menu;
+        END IF;
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE menus SET submenus_count = submenus_count + 1, dishes_count = dishes_count + NEW.dishes_count
+        WHERE id = NEW.menu;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE menus SET submenus_count = submenus_count - 1, dishes_count = dishes_count - OLD.dishes_count
+        WHERE id = OLD.menu;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER count_dishes AFTER INSERT OR DELETE OR UPDATE OF submenu ON dishes
+    FOR EACH ROW EXECUTE FUNCTION count_dishes();
+CREATE TRIGGER count_submenus AFTER INSERT OR DELETE OR UPDATE OF menu, dishes_count ON submenus
+    FOR EACH ROW EXECUTE FUNCTION count_submenus();
@@ -0,0 +1,4 @@
+-- Postgres does not index referencing columns, without these the submenu/dish lookups
+-- and every ON DELETE CASCADE scan the whole child table
+CREATE INDEX IF NOT EXISTS submenus_menu_idx ON submenus (menu);
+CREATE INDEX IF NOT EXISTS dishes_submenu_idx ON dishes (submenu);
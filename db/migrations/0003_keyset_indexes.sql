@@ -0,0 +1,6 @@
+-- Child collections are paged with "WHERE parent = $1 AND id > $2 ORDER BY id", a composite
+-- index answers that without a sort and still covers the foreign key lookups
+CREATE INDEX IF NOT EXISTS submenus_menu_id_idx ON submenus (menu, id);
+CREATE INDEX IF NOT EXISTS dishes_submenu_id_idx ON dishes (submenu, id);
+DROP INDEX IF EXISTS submenus_menu_idx;
+DROP INDEX IF EXISTS dishes_submenu_idx;
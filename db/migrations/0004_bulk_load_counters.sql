@@ -0,0 +1,42 @@
+-- Bulk loads insert rows with their counters already computed and set ylab.bulk_load for the
+-- transaction, so the per-row counter triggers step aside instead of updating parents per row
+CREATE OR REPLACE FUNCTION count_dishes() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('ylab.bulk_load', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' AND NEW.submenu IS NOT DISTINCT FROM OLD.submenu THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE submenus SET dishes_count = dishes_count + 1 WHERE id = NEW.submenu;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE submenus SET dishes_count = dishes_count - 1 WHERE id = OLD.submenu;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_submenus() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('ylab.bulk_load', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' AND NEW.menu IS NOT DISTINCT FROM OLD.menu THEN
+        IF NEW.dishes_count <> OLD.dishes_count THEN
+            UPDATE menus SET dishes_count = dishes_count + NEW.dishes_count - OLD.dishes_count WHERE id = NEW.menu;
+        END IF;
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE menus SET submenus_count = submenus_count + 1, dishes_count = dishes_count + NEW.dishes_count
+        WHERE id = NEW.menu;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE menus SET submenus_count = submenus_count - 1, dishes_count = dishes_count - OLD.dishes_count
+        WHERE id = OLD.menu;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
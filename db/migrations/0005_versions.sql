@@ -0,0 +1,18 @@
+-- Every row carries a version drawn from one sequence and replaced on each update, so a
+-- single version or (count, max version) over a collection identifies what a GET returned.
+-- Counter updates made by the triggers bump the parents as well.
+CREATE SEQUENCE entity_version_seq;
+ALTER TABLE menus ADD COLUMN version BIGINT NOT NULL DEFAULT nextval('entity_version_seq');
+ALTER TABLE submenus ADD COLUMN version BIGINT NOT NULL DEFAULT nextval('entity_version_seq');
+ALTER TABLE dishes ADD COLUMN version BIGINT NOT NULL DEFAULT nextval('entity_version_seq');
+
+CREATE OR REPLACE FUNCTION bump_version() RETURNS trigger AS $$
+BEGIN
+    NEW.version := nextval('entity_version_seq');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bump_version BEFORE UPDATE ON menus FOR EACH ROW EXECUTE FUNCTION bump_version();
+CREATE TRIGGER bump_version BEFORE UPDATE ON submenus FOR EACH ROW EXECUTE FUNCTION bump_version();
+CREATE TRIGGER bump_version BEFORE UPDATE ON dishes FOR EACH ROW EXECUTE FUNCTION bump_version();
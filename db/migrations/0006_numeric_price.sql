@@ -0,0 +1,20 @@
+-- Prices become numbers so they can be filtered, sorted and aggregated in SQL. A price that does
+-- not parse as a number or does not fit NUMERIC(10, 2) stops the migration with the ids of the
+-- dishes to fix by hand, blank prices become NULL.
+DO $$
+DECLARE
+    invalid TEXT;
+BEGIN
+    SELECT string_agg(id::text, ', ' ORDER BY id) INTO invalid FROM dishes
+    WHERE CASE WHEN price ~ '^\s*-?[0-9]+(\.[0-9]*)?\s*$' THEN abs(round(trim(price)::numeric, 2)) >= 1e8
+               ELSE price !~ '^\s*$' END;
+    IF invalid IS NOT NULL THEN
+        RAISE EXCEPTION 'dishes % have a price that is not a number of at most 8 integer digits', invalid;
+    END IF;
+END
+$$;
+ALTER TABLE dishes ALTER COLUMN price TYPE NUMERIC(10, 2) USING
+    CASE WHEN price !~ '^\s*$' THEN round(trim(price)::numeric, 2) END;
+
+-- Serves price ranges, price order and the price stats within a submenu
+CREATE INDEX dishes_submenu_price_idx ON dishes (submenu, price, id);
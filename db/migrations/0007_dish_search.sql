@@ -0,0 +1,8 @@
+-- Full-text search over dish titles and descriptions. The 'simple' configuration only lowercases,
+-- so it works the same for any language and prefix queries match what was typed. Postgres keeps
+-- the generated column up to date on every insert and update.
+ALTER TABLE dishes ADD COLUMN search tsvector GENERATED ALWAYS AS (
+    setweight(to_tsvector('simple', COALESCE(title, '')), 'A') ||
+    setweight(to_tsvector('simple', COALESCE(description, '')), 'B')) STORED;
+
+CREATE INDEX dishes_search_idx ON dishes USING GIN (search);
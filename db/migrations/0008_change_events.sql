@@ -0,0 +1,51 @@
+-- Every committed write to a menu, submenu or dish is announced on the ylab_changes channel.
+-- Rows changed by other triggers (counters, cascaded deletes) and bulk loads are implied by
+-- the change that caused them and stay quiet. Event ids come from one sequence so any process
+-- can recognise a resume token.
+CREATE SEQUENCE change_event_seq;
+
+CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger AS $$
+DECLARE
+    item RECORD;
+    entity TEXT;
+    menu_id BIGINT;
+    submenu_id BIGINT;
+BEGIN
+    IF pg_trigger_depth() > 1 OR current_setting('ylab.bulk_load', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        item := OLD;
+    ELSE
+        item := NEW;
+    END IF;
+    IF TG_TABLE_NAME = 'menus' THEN
+        entity := 'menu';
+        menu_id := item.id;
+    ELSIF TG_TABLE_NAME = 'submenus' THEN
+        entity := 'submenu';
+        menu_id := item.menu;
+        submenu_id := item.id;
+    ELSE
+        entity := 'dish';
+        submenu_id := item.submenu;
+        SELECT menu INTO menu_id FROM submenus WHERE id = submenu_id;
+    END IF;
+    PERFORM pg_notify('ylab_changes', json_build_object(
+        'event', nextval('change_event_seq')::text,
+        'entity', entity,
+        'op', lower(TG_OP),
+        'id', item.id::text,
+        'menu_id', menu_id::text,
+        'submenu_id', submenu_id::text,
+        'version', CASE WHEN TG_OP = 'DELETE' THEN NULL ELSE item.version::text END)::text);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_change AFTER INSERT OR UPDATE OR DELETE ON menus
+    FOR EACH ROW EXECUTE FUNCTION notify_change();
+CREATE TRIGGER notify_change AFTER INSERT OR UPDATE OR DELETE ON submenus
+    FOR EACH ROW EXECUTE FUNCTION notify_change();
+CREATE TRIGGER notify_change AFTER INSERT OR UPDATE OR DELETE ON dishes
+    FOR EACH ROW EXECUTE FUNCTION notify_change();
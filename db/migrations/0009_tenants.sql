@@ -0,0 +1,172 @@
+-- Every restaurant (tenant) has its own menus, submenus and dishes. The tables are hash
+-- partitioned by tenant and every statement filters on it, so a request only reaches the
+-- partition holding its tenant. Postgres can't partition a table in place: the rows move to new
+-- tables, all of them to the 'default' tenant, and the old tables are dropped. Ids still come
+-- from the same sequences and stay unique across tenants.
+ALTER SEQUENCE menus_id_seq OWNED BY NONE;
+ALTER SEQUENCE submenus_id_seq OWNED BY NONE;
+ALTER SEQUENCE dishes_id_seq OWNED BY NONE;
+ALTER TABLE menus RENAME TO menus_old;
+ALTER TABLE submenus RENAME TO submenus_old;
+ALTER TABLE dishes RENAME TO dishes_old;
+
+CREATE TABLE menus (
+    tenant TEXT NOT NULL,
+    id INT NOT NULL DEFAULT nextval('menus_id_seq'),
+    title VARCHAR(150),
+    description VARCHAR(150),
+    submenus_count INT NOT NULL DEFAULT 0,
+    dishes_count INT NOT NULL DEFAULT 0,
+    version BIGINT NOT NULL DEFAULT nextval('entity_version_seq')) PARTITION BY HASH (tenant);
+CREATE TABLE submenus (
+    tenant TEXT NOT NULL,
+    id INT NOT NULL DEFAULT nextval('submenus_id_seq'),
+    menu INT,
+    title VARCHAR(150),
+    description VARCHAR(150),
+    dishes_count INT NOT NULL DEFAULT 0,
+    version BIGINT NOT NULL DEFAULT nextval('entity_version_seq')) PARTITION BY HASH (tenant);
+CREATE TABLE dishes (
+    tenant TEXT NOT NULL,
+    id INT NOT NULL DEFAULT nextval('dishes_id_seq'),
+    submenu INT,
+    title VARCHAR(150),
+    description VARCHAR(150),
+    price NUMERIC(10, 2),
+    version BIGINT NOT NULL DEFAULT nextval('entity_version_seq'),
+    search tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', COALESCE(title, '')), 'A') ||
+        setweight(to_tsvector('simple', COALESCE(description, '')), 'B')) STORED) PARTITION BY HASH (tenant);
+
+-- 16 partitions per table, a tenant's rows always share one with the same few other tenants
+DO $$
+BEGIN
+    FOR remainder IN 0..15 LOOP
+        EXECUTE format('CREATE TABLE menus_%s PARTITION OF menus FOR VALUES WITH (MODULUS 16, REMAINDER %s)',
+                       remainder, remainder);
+        EXECUTE format('CREATE TABLE submenus_%s PARTITION OF submenus FOR VALUES WITH (MODULUS 16, REMAINDER %s)',
+                       remainder, remainder);
+        EXECUTE format('CREATE TABLE dishes_%s PARTITION OF dishes FOR VALUES WITH (MODULUS 16, REMAINDER %s)',
+                       remainder, remainder);
+    END LOOP;
+END
+$$;
+
+INSERT INTO menus (tenant, id, title, description, submenus_count, dishes_count, version)
+SELECT 'default', id, title, description, submenus_count, dishes_count, version FROM menus_old;
+INSERT INTO submenus (tenant, id, menu, title, description, dishes_count, version)
+SELECT 'default', id, menu, title, description, dishes_count, version FROM submenus_old;
+INSERT INTO dishes (tenant, id, submenu, title, description, price, version)
+SELECT 'default', id, submenu, title, description, price, version FROM dishes_old;
+DROP TABLE dishes_old, submenus_old, menus_old;
+ALTER SEQUENCE menus_id_seq OWNED BY menus.id;
+ALTER SEQUENCE submenus_id_seq OWNED BY submenus.id;
+ALTER SEQUENCE dishes_id_seq OWNED BY dishes.id;
+
+-- Keys and indexes lead with the partition key, each partition gets its own copy
+ALTER TABLE menus ADD PRIMARY KEY (tenant, id);
+ALTER TABLE submenus ADD PRIMARY KEY (tenant, id);
+ALTER TABLE dishes ADD PRIMARY KEY (tenant, id);
+ALTER TABLE submenus ADD FOREIGN KEY (tenant, menu) REFERENCES menus (tenant, id) ON DELETE CASCADE;
+ALTER TABLE dishes ADD FOREIGN KEY (tenant, submenu) REFERENCES submenus (tenant, id) ON DELETE CASCADE;
+CREATE INDEX submenus_menu_id_idx ON submenus (tenant, menu, id);
+CREATE INDEX dishes_submenu_id_idx ON dishes (tenant, submenu, id);
+CREATE INDEX dishes_submenu_price_idx ON dishes (tenant, submenu, price, id);
+CREATE INDEX dishes_search_idx ON dishes USING GIN (search);
+
+-- The triggers went with the old tables. The counters and the dish's menu are looked up
+-- within the row's tenant, so they stay in its partition too.
+CREATE OR REPLACE FUNCTION count_dishes() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('ylab.bulk_load', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' AND NEW.submenu IS NOT DISTINCT FROM OLD.submenu THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE submenus SET dishes_count = dishes_count + 1 WHERE tenant = NEW.tenant AND id = NEW.submenu;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE submenus SET dishes_count = dishes_count - 1 WHERE tenant = OLD.tenant AND id = OLD.submenu;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_submenus() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('ylab.bulk_load', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' AND NEW.menu IS NOT DISTINCT FROM OLD.menu THEN
+        IF NEW.dishes_count <> OLD.dishes_count THEN
+            UPDATE menus SET dishes_count = dishes_count + NEW.dishes_count - OLD.dishes_count
+            WHERE tenant = NEW.tenant AND id = NEW.menu;
+        END IF;
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE menus SET submenus_count = submenus_count + 1, dishes_count = dishes_count + NEW.dishes_count
+        WHERE tenant = NEW.tenant AND id = NEW.menu;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE menus SET submenus_count = submenus_count - 1, dishes_count = dishes_count - OLD.dishes_count
+        WHERE tenant = OLD.tenant AND id = OLD.menu;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- Change events carry the tenant, the feed only sends a subscriber its own tenant's. The row
+-- triggers fire with the partition's name in TG_TABLE_NAME, the entity comes as an argument.
+CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger AS $$
+DECLARE
+    item RECORD;
+    entity TEXT := TG_ARGV[0];
+    menu_id BIGINT;
+    submenu_id BIGINT;
+BEGIN
+    IF pg_trigger_depth() > 1 OR current_setting('ylab.bulk_load', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        item := OLD;
+    ELSE
+        item := NEW;
+    END IF;
+    IF entity = 'menu' THEN
+        menu_id := item.id;
+    ELSIF entity = 'submenu' THEN
+        menu_id := item.menu;
+        submenu_id := item.id;
+    ELSE
+        submenu_id := item.submenu;
+        SELECT menu INTO menu_id FROM submenus WHERE tenant = item.tenant AND id = submenu_id;
+    END IF;
+    PERFORM pg_notify('ylab_changes', json_build_object(
+        'event', nextval('change_event_seq')::text,
+        'tenant', item.tenant,
+        'entity', entity,
+        'op', lower(TG_OP),
+        'id', item.id::text,
+        'menu_id', menu_id::text,
+        'submenu_id', submenu_id::text,
+        'version', CASE WHEN TG_OP = 'DELETE' THEN NULL ELSE item.version::text END)::text);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER count_dishes AFTER INSERT OR DELETE OR UPDATE OF submenu ON dishes
+    FOR EACH ROW EXECUTE FUNCTION count_dishes();
+CREATE TRIGGER count_submenus AFTER INSERT OR DELETE OR UPDATE OF menu, dishes_count ON submenus
+    FOR EACH ROW EXECUTE FUNCTION count_submenus();
+CREATE TRIGGER bump_version BEFORE UPDATE ON menus FOR EACH ROW EXECUTE FUNCTION bump_version();
+CREATE TRIGGER bump_version BEFORE UPDATE ON submenus FOR EACH ROW EXECUTE FUNCTION bump_version();
+CREATE TRIGGER bump_version BEFORE UPDATE ON dishes FOR EACH ROW EXECUTE FUNCTION bump_version();
+CREATE TRIGGER notify_change AFTER INSERT OR UPDATE OR DELETE ON menus
+    FOR EACH ROW EXECUTE FUNCTION notify_change('menu');
+CREATE TRIGGER notify_change AFTER INSERT OR UPDATE OR DELETE ON submenus
+    FOR EACH ROW EXECUTE FUNCTION notify_change('submenu');
+CREATE TRIGGER notify_change AFTER INSERT OR UPDATE OR DELETE ON dishes
+    FOR EACH ROW EXECUTE FUNCTION notify_change('dish');
@@ -0,0 +1,294 @@
+from decimal import Decimal
+from re import findall
+from typing import NamedTuple
+
+# Every statement the API runs, written once with $n placeholders. The engines prepare a Query
+# once per connection under its name (server-side PREPARE for psycopg2, the statement cache for
+# asyncpg), so the hot paths only bind values instead of parsing and planning again.
+
+
+class Query(NamedTuple):
+    name: str
+    sql: str
+
+
+class Projection(NamedTuple):
+    # A statement whose select list is picked per request from columns; each distinct
+    # selection becomes its own prepared statement. version is the rows' version column, read
+    # with every page so it can be tagged from the rows it holds; None leaves the results out
+    # of the cache and ETags.
+    # The rows end with the keyset columns (name: type) the statement is ordered by; start is
+    # the cursor of the first page.
+    name: str
+    sql: str
+    columns: dict
+    version: str | None
+    keys: dict = {"id": int}
+    order: str = "id"
+    start: tuple = (0,)
+
+    def positions(self, names):
+        return "_".join(str(list(self.columns).index(name)) for name in names)
+
+    def select(self, names):
+        # The rows are the columns in names, the version if there is one, then the keys
+        select = ", ".join([*(self.columns[name] for name in names), *([self.version] if self.version else [])])
+        return Query(f"{self.name}_{self.positions(names)}", self.sql.format(select))
+
+    def select_version(self):
+        # Only the versions and keys of a page, for answering If-None-Match
+        return Query(f"{self.name}_version", self.sql.format(self.version))
+
+    def select_json(self, names):
+        # One row: the page as a JSON array built by Postgres, the cursor when there is a next
+        # page and the "id:version,...[,+]" string the page is tagged from. The last parameter is the LIMIT, one more
+        # than the page size.
+        limit = "$" + str(max(int(number) for number in findall(r"\$(\d+)", self.sql)))
+        item = "json_build_object(" + ", ".join(f"'{name}', {self.columns[name]}" for name in names) + ") AS item"
+        cursor = f"concat_ws(',', {', '.join(self.keys)})"
+        if self.version:
+            item += f", {self.version} AS version"
+            versions = (f"COALESCE(array_to_string((array_agg(id || ':' || version ORDER BY {self.order}))"
+                        f"[1:{limit}::int - 1], ','), '') || CASE WHEN count(*) = {limit} THEN ',+' ELSE '' END")
+        else:
+            versions = "NULL"
+        return Query(f"{self.name}_json_{self.positions(names)}", f"""
+SELECT
+    COALESCE(array_to_json((array_agg(item ORDER BY {self.order}))[1:{limit}::int - 1]), '[]')::text,
+    CASE WHEN count(*) = {limit} THEN (array_agg({cursor} ORDER BY {self.order}))[{limit}::int - 1] END,
+    {versions}
+FROM ({self.sql.format(item)}) page
+""")
+
+
+# Menus. Every statement takes the tenant as $1, filtering on it prunes to its partition.
+GET_MENUS = Projection("get_menus", """
+SELECT {}, m.id
+FROM menus m
+WHERE m.tenant = $1 AND m.id > $2
+ORDER BY m.id
+LIMIT $3
+""", {"id": "m.id::text", "title": "m.title", "description": "m.description",
+      "submenus_count": "m.submenus_count", "dishes_count": "m.dishes_count"}, "m.version")
+
+GET_MENU = Query("get_menu", """
+SELECT
+    id::text,
+    title,
+    description,
+    submenus_count,
+    dishes_count,
+    version::text
+FROM menus
+WHERE tenant = $1 AND id = $2
+""")
+
+MENU_VERSION = Query("menu_version", "SELECT version::text FROM menus WHERE tenant = $1 AND id = $2")
+
+CREATE_MENU = Query("create_menu",
+                    "INSERT INTO menus (tenant, title, description) VALUES ($1, $2, $3) RETURNING id")
+
+UPDATE_MENU = Query("update_menu", "UPDATE menus SET (title, description) = ($2, $3) WHERE tenant = $1 AND id = $4")
+
+DELETE_MENU = Query("delete_menu", "DELETE FROM menus WHERE tenant = $1 AND id = $2")
+
+# Submenus
+GET_SUBMENUS = Projection("get_submenus", """
+SELECT {}, s.id
+FROM submenus s
+WHERE s.tenant = $1 AND s.menu = $2 AND s.id > $3
+ORDER BY s.id
+LIMIT $4
+""", {"id": "s.id::text", "title": "s.title", "description": "s.description",
+      "dishes_count": "s.dishes_count"}, "s.version")
+
+GET_SUBMENU = Query("get_submenu", """
+SELECT
+    id::text,
+    title,
+    description,
+    dishes_count,
+    version::text
+FROM submenus
+WHERE tenant = $1 AND menu = $2 AND id = $3
+""")
+
+SUBMENU_VERSION = Query("submenu_version",
+                        "SELECT version::text FROM submenus WHERE tenant = $1 AND menu = $2 AND id = $3")
+
+# Creates return no id when the parent does not exist
+CREATE_SUBMENU = Query("create_submenu", """
+INSERT INTO submenus (tenant, menu, title, description)
+SELECT tenant, id, $3::text, $4::text FROM menus WHERE tenant = $1 AND id = $2
+RETURNING id
+""")
+
+UPDATE_SUBMENU = Query("update_submenu", """
+UPDATE submenus SET (title, description) = ($2, $3) WHERE tenant = $1 AND menu = $4 AND id = $5
+""")
+
+DELETE_SUBMENU = Query("delete_submenu", "DELETE FROM submenus WHERE tenant = $1 AND menu = $2 AND id = $3")
+
+# Dishes, optionally limited to a price range ($4, $5 may be NULL)
+DISH_COLUMNS = {"id": "d.id::text", "title": "d.title", "description": "d.description", "price": "d.price::text"}
+
+GET_DISHES = Projection("get_dishes", """
+SELECT {}, d.id
+FROM submenus s
+INNER JOIN dishes d ON s.tenant = d.tenant AND s.id = d.submenu
+WHERE s.tenant = $1 AND s.menu = $2 AND s.id = $3
+    AND ($4::numeric IS NULL OR d.price >= $4) AND ($5::numeric IS NULL OR d.price <= $5)
+    AND d.id > $6
+ORDER BY d.id
+LIMIT $7
+""", DISH_COLUMNS, "d.version")
+
+# Price order pages on (price, id); dishes without a price are left out
+GET_DISHES_BY_PRICE = Projection("get_dishes_by_price", """
+SELECT {}, d.price, d.id
+FROM submenus s
+INNER JOIN dishes d ON s.tenant = d.tenant AND s.id = d.submenu
+WHERE s.tenant = $1 AND s.menu = $2 AND s.id = $3
+    AND ($4::numeric IS NULL OR d.price >= $4) AND ($5::numeric IS NULL OR d.price <= $5)
+    AND d.price IS NOT NULL AND ($6::numeric IS NULL OR (d.price, d.id) > ($6, $7))
+ORDER BY d.price, d.id
+LIMIT $8
+""", DISH_COLUMNS, "d.version", {"price": Decimal, "id": int}, "price, id", (None, 0))
+
+GET_DISHES_BY_PRICE_DESC = Projection("get_dishes_by_price_desc", """
+SELECT {}, d.price, d.id
+FROM submenus s
+INNER JOIN dishes d ON s.tenant = d.tenant AND s.id = d.submenu
+WHERE s.tenant = $1 AND s.menu = $2 AND s.id = $3
+    AND ($4::numeric IS NULL OR d.price >= $4) AND ($5::numeric IS NULL OR d.price <= $5)
+    AND d.price IS NOT NULL AND ($6::numeric IS NULL OR (d.price, d.id) < ($6, $7))
+ORDER BY d.price DESC, d.id DESC
+LIMIT $8
+""", DISH_COLUMNS, "d.version", {"price": Decimal, "id": int}, "price DESC, id DESC", (None, 0))
+
+GET_DISH = Query("get_dish", """
+SELECT
+    d.id::text,
+    d.title,
+    d.description,
+    d.price::text,
+    d.version::text
+FROM submenus s
+INNER JOIN dishes d ON s.tenant = d.tenant AND s.id = d.submenu
+WHERE s.tenant = $1 AND s.menu = $2 AND s.id = $3 AND d.id = $4
+""")
+
+DISH_VERSION = Query("dish_version", """
+SELECT d.version::text
+FROM submenus s
+INNER JOIN dishes d ON s.tenant = d.tenant AND s.id = d.submenu
+WHERE s.tenant = $1 AND s.menu = $2 AND s.id = $3 AND d.id = $4
+""")
+
+CREATE_DISH = Query("create_dish", """
+INSERT INTO dishes (tenant, submenu, title, description, price)
+SELECT tenant, id, $4::text, $5::text, $6::numeric FROM submenus WHERE tenant = $1 AND menu = $2 AND id = $3
+RETURNING id
+""")
+
+# Dish writes check the whole path like the reads, a dish is only found under its own menu
+UPDATE_DISH = Query("update_dish", """
+UPDATE dishes SET (title, description, price) = ($2, $3, $4)
+WHERE tenant = $1 AND submenu IN (SELECT id FROM submenus WHERE tenant = $1 AND menu = $5 AND id = $6) AND id = $7
+""")
+
+DELETE_DISH = Query("delete_dish", """
+DELETE FROM dishes
+WHERE tenant = $1 AND submenu IN (SELECT id FROM submenus WHERE tenant = $1 AND menu = $2 AND id = $3) AND id = $4
+""")
+
+# Price stats, one aggregate over the (tenant, submenu, price, id) index. Grouped by the parent,
+# so there is no row when it does not exist.
+MENU_STATS = Query("menu_stats", """
+SELECT count(d.id), min(d.price)::text, round(avg(d.price), 2)::text, max(d.price)::text
+FROM menus m
+LEFT JOIN submenus s ON m.tenant = s.tenant AND m.id = s.menu
+LEFT JOIN dishes d ON s.tenant = d.tenant AND s.id = d.submenu
+WHERE m.tenant = $1 AND m.id = $2
+GROUP BY m.id
+""")
+
+SUBMENU_STATS = Query("submenu_stats", """
+SELECT count(d.id), min(d.price)::text, round(avg(d.price), 2)::text, max(d.price)::text
+FROM submenus s
+LEFT JOIN dishes d ON s.tenant = d.tenant AND s.id = d.submenu
+WHERE s.tenant = $1 AND s.menu = $2 AND s.id = $3
+GROUP BY s.id
+""")
+
+# Dish search, $2 is a to_tsquery expression. Best matches first, the cursor is (rank, id).
+SEARCH_DISHES = Projection("search_dishes", """
+SELECT {}, h.rank, h.id
+FROM (
+    SELECT d.id, d.submenu, d.title, d.description, d.price, s.menu, ts_rank(d.search, q) AS rank
+    FROM to_tsquery('simple', $2) q
+    INNER JOIN dishes d ON d.tenant = $1 AND d.search @@ q
+    INNER JOIN submenus s ON s.tenant = d.tenant AND s.id = d.submenu) h
+WHERE $3::real IS NULL OR h.rank < $3 OR (h.rank = $3 AND h.id > $4)
+ORDER BY h.rank DESC, h.id
+LIMIT $5
+""", {"id": "h.id::text", "title": "h.title", "description": "h.description", "price": "h.price::text",
+      "menu_id": "h.menu::text", "submenu_id": "h.submenu::text", "rank": "h.rank"},
+    None, {"rank": float, "id": int}, "rank DESC, id", (None, 0))
+
+# Bulk loads skip the per-row change events and announce themselves once, see 0008_change_events
+NOTIFY_IMPORT = Query("notify_import", """
+SELECT pg_notify('ylab_changes', json_build_object(
+    'event', nextval('change_event_seq')::text, 'tenant', $1::text, 'entity', 'menu', 'op', 'import', 'id', NULL,
+    'menu_id', NULL, 'submenu_id', NULL, 'version', NULL)::text)
+""")
+
+# One JSON document per menu with its submenus and dishes nested, built by Postgres
+TREE = """
+SELECT json_build_object(
+    'id', m.id::text,
+    'title', m.title,
+    'description', m.description,
+    'submenus', COALESCE((
+        SELECT json_agg(json_build_object(
+            'id', s.id::text,
+            'title', s.title,
+            'description', s.description,
+            'dishes', COALESCE((
+                SELECT json_agg(json_build_object(
+                    'id', d.id::text,
+                    'title', d.title,
+                    'description', d.description,
+                    'price', d.price::text) ORDER BY d.id)
+                FROM dishes d
+                WHERE d.tenant = s.tenant AND d.submenu = s.id), '[]'))
+            ORDER BY s.id)
+        FROM submenus s
+        WHERE s.tenant = m.tenant AND s.menu = m.id), '[]'))::text
+FROM menus m
+"""
+
+# Read through a server-side cursor, which cannot run a prepared statement
+GET_MENUS_TREE = TREE + "WHERE m.tenant = $1 ORDER BY m.id"
+
+GET_MENU_TREE = Query("get_menu_tree", TREE + "WHERE m.tenant = $1 AND m.id = $2")
+
+# Flat dump for CSV export, one row per dish (menus and submenus without children get one row)
+EXPORT = """
+SELECT
+    m.id AS menu_id,
+    m.title AS menu_title,
+    m.description AS menu_description,
+    s.id AS submenu_id,
+    s.title AS submenu_title,
+    s.description AS submenu_description,
+    d.id AS dish_id,
+    d.title AS dish_title,
+    d.description AS dish_description,
+    d.price AS dish_price
+FROM menus m
+LEFT OUTER JOIN submenus s ON m.tenant = s.tenant AND m.id = s.menu
+LEFT OUTER JOIN dishes d ON s.tenant = d.tenant AND s.id = d.submenu
+WHERE m.tenant = $1
+ORDER BY m.id, s.id, d.id
+"""
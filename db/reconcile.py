@@ -0,0 +1,64 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+
+from anyio import run
+from db.dbconnection import close, database
+
+# Recount the denormalized counters from the rows themselves. Submenus go first: fixing them
+# fires the submenu trigger, and the menu pass then overwrites with absolute values anyway.
+# Without a tenant every tenant is recounted in one go, {tenant} narrows the rows to one.
+RECONCILE_SUBMENUS = """
+UPDATE submenus s SET dishes_count = c.dishes
+FROM (
+    SELECT s.tenant, s.id, COUNT(d.id) AS dishes
+    FROM submenus s
+    LEFT OUTER JOIN dishes d ON s.tenant = d.tenant AND s.id = d.submenu
+    WHERE {tenant}
+    GROUP BY s.tenant, s.id) c
+WHERE s.tenant = c.tenant AND s.id = c.id AND s.dishes_count <> c.dishes
+"""
+
+RECONCILE_MENUS = """
+UPDATE menus m SET submenus_count = c.submenus, dishes_count = c.dishes
+FROM (
+    SELECT m.tenant, m.id, COUNT(s.id) AS submenus, COALESCE(SUM(s.dishes_count), 0) AS dishes
+    FROM menus m
+    LEFT OUTER JOIN submenus s ON m.tenant = s.tenant AND m.id = s.menu
+    WHERE {tenant}
+    GROUP BY m.tenant, m.id) c
+WHERE m.tenant = c.tenant AND m.id = c.id AND (m.submenus_count, m.dishes_count) <> (c.submenus, c.dishes)
+"""
+
+# A tenant's counters are locked in the order the triggers take them, submenus before menus.
+# Writes adding or removing its rows wait on their counter, other tenants are not blocked.
+LOCK_TENANT_SUBMENUS = "SELECT id FROM submenus WHERE tenant = $1 ORDER BY id FOR UPDATE"
+LOCK_TENANT_MENUS = "SELECT id FROM menus WHERE tenant = $1 ORDER BY id FOR UPDATE"
+
+
+async def reconcile(tenant=None):
+    async with database() as db:
+        async with db.transaction():
+            if tenant is None:
+                # Writers wait for the few milliseconds this takes, readers are not blocked
+                await db.execute("LOCK TABLE menus, submenus, dishes IN SHARE MODE")
+                submenus = await db.execute(RECONCILE_SUBMENUS.format(tenant="true"))
+                menus = await db.execute(RECONCILE_MENUS.format(tenant="true"))
+            else:
+                await db.execute(LOCK_TENANT_SUBMENUS, tenant)
+                await db.execute(LOCK_TENANT_MENUS, tenant)
+                submenus = await db.execute(RECONCILE_SUBMENUS.format(tenant="s.tenant = $1"), tenant)
+                menus = await db.execute(RECONCILE_MENUS.format(tenant="m.tenant = $1"), tenant)
+    return {"menus": menus, "submenus": submenus}
+
+
+async def main():
+    try:
+        repaired = await reconcile()
+    finally:
+        await close()
+    print(f"Repaired {repaired['menus']} menus and {repaired['submenus']} submenus")
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,24 @@
+from itertools import count
+from time import monotonic
+from db.settings import replica_retry
+
+# Reads go round-robin over the replicas. One that cannot be reached sits out for replica_retry
+# seconds; with none left the primary serves the read.
+
+
+class Router:
+    def __init__(self, replicas):
+        self.replicas = replicas
+        self.turn = count()
+        self.down_until = {}
+
+    def candidates(self):
+        if not self.replicas:
+            return []
+        start = next(self.turn) % len(self.replicas)
+        now = monotonic()
+        return [replica for replica in self.replicas[start:] + self.replicas[:start]
+                if self.down_until.get(id(replica), 0) <= now]
+
+    def down(self, replica):
+        self.down_until[id(replica)] = monotonic() + replica_retry
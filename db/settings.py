@@ -0,0 +1,48 @@
+from dotenv import load_dotenv
+from os import environ, path
+
+
+dotenv_path = path.abspath(path.join(path.dirname(__file__), '..', '.env'))
+if path.exists(dotenv_path):
+    load_dotenv(dotenv_path)
+
+
+if environ.get('TEST') == "False":
+    db_settings = {"database": environ.get('POSTGRES_TYPE'),
+                   "user": environ.get('POSTGRES_USER'),
+                   "password": environ.get('POSTGRES_PASSWORD'),
+                   "host": environ.get('POSTGRES_HOST'),
+                   "port": int(environ.get('POSTGRES_PORT'))}
+else:
+    db_settings = {"database": environ.get('POSTGRES_TEST_DB'),
+                   "user": environ.get('POSTGRES_USER'),
+                   "password": environ.get('POSTGRES_PASSWORD'),
+                   "host": environ.get('POSTGRES_TEST_HOST'),
+                   "port": int(environ.get('POSTGRES_TEST_PORT'))}
+
+# Optional streaming replicas for the read-only endpoints, "host[:port],host[:port]". The
+# database, user and password are the primary's.
+replica_hosts = [host.strip().partition(":") for host in environ.get('POSTGRES_REPLICA_HOSTS', '').split(",")
+                 if host.strip()]
+replica_settings = [{**db_settings, "host": host, "port": int(port or db_settings["port"])}
+                    for host, _, port in replica_hosts]
+replica_timeout = int(environ.get('POSTGRES_REPLICA_TIMEOUT', 2))
+replica_retry = float(environ.get('POSTGRES_REPLICA_RETRY', 30))
+# Seconds a client keeps reading from the primary after its own write, 0 turns it off
+read_your_writes = int(environ.get('POSTGRES_READ_YOUR_WRITES', 5))
+
+pool_settings = {"minconn": int(environ.get('POSTGRES_POOL_MIN', 1)),
+                 "maxconn": int(environ.get('POSTGRES_POOL_MAX', 10))}
+pool_timeout = float(environ.get('POSTGRES_POOL_TIMEOUT', 30))
+
+# "python" builds list bodies from rows with orjson, "postgres" has Postgres return them as JSON text
+list_json = environ.get('LIST_JSON', 'python')
+
+# "sync" runs psycopg2 on worker threads, "async" runs asyncpg on the event loop
+engine = environ.get('DB_ENGINE', 'sync')
+
+# Tenant of requests that name none and of the rows from before tenancy, empty makes naming one mandatory
+default_tenant = environ.get('TENANT_DEFAULT', 'default')
+
+# Statements slower than this many milliseconds are logged with their SQL, 0 turns it off
+slow_query_ms = float(environ.get('SLOW_QUERY_MS', 0))
@@ -0,0 +1,60 @@
+from logging import getLogger
+from db.queries import Query
+from db.settings import slow_query_ms
+
+# Timings are recorded on the event loop after each call returns, so plain dicts are enough.
+# Statements are labelled by their Query name, ad hoc SQL by its first words.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+slow_log = getLogger("db.slow")
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        position = 0
+        while position < len(self.buckets) and value > self.buckets[position]:
+            position += 1
+        self.counts[position] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Statement:
+    def __init__(self):
+        self.duration = Histogram()
+        self.rows = 0
+
+
+statements = {}
+pool_wait = Histogram()
+
+
+def label(query):
+    if isinstance(query, Query):
+        return query.name
+    return " ".join(query.split()[:4])
+
+
+def observe(query, args, seconds, rows):
+    name = label(query)
+    statement = statements.get(name)
+    if statement is None:
+        statement = statements[name] = Statement()
+    statement.duration.observe(seconds)
+    statement.rows += max(rows, 0)
+    if slow_query_ms and seconds * 1000 >= slow_query_ms:
+        sql = query.sql if isinstance(query, Query) else query
+        slow_log.warning("slow query %s took %.1f ms, %d rows, args %r\n%s",
+                         name, seconds * 1000, rows, args, sql.strip())
+
@@ -0,0 +1,331 @@
+from anyio import move_on_after, to_thread, wait_socket_readable
+from os import register_at_fork
+from io import StringIO
+from queue import Queue
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from re import sub
+from threading import BoundedSemaphore, Lock, Thread
+from time import perf_counter
+from psycopg2 import OperationalError, connect
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, connection as Connection
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from db import stats
+from db.queries import Query
+from db.router import Router
+from db.settings import db_settings, pool_settings, pool_timeout, replica_settings, replica_timeout
+
+class PreparedConnection(Connection):
+    # Names of the statements prepared on this session, they live until it is closed
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def healthy(connection):
+    # A broken socket leaves the connection closed or in an unknown transaction state
+    return not connection.closed and connection.get_transaction_status() == TRANSACTION_STATUS_IDLE
+
+
+class Pool:
+    # One per server. ThreadedConnectionPool fails instead of waiting when exhausted, so
+    # callers queue on slots; it is opened on first use so importing never touches the network
+    def __init__(self, settings):
+        self.settings = settings
+        self.pool = None
+        self.lock = Lock()
+        self.slots = BoundedSemaphore(pool_settings["maxconn"])
+
+    def get(self):
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ThreadedConnectionPool(**pool_settings, **self.settings,
+                                                       connection_factory=PreparedConnection)
+        return self.pool
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+
+    def forget(self):
+        # A forked worker must neither use nor close the parent's sockets: closing would end
+        # the parent's sessions. The inherited pool stays referenced and a fresh one opens lazily.
+        if self.pool is not None:
+            inherited.append(self.pool)
+        self.pool = None
+        self.lock = Lock()
+        self.slots = BoundedSemaphore(pool_settings["maxconn"])
+
+    def checkout(self):
+        if not self.slots.acquire(timeout=pool_timeout):
+            raise PoolError("timed out waiting for a database connection")
+        try:
+            # Discard dead connections until a live one is returned, the pool reconnects on demand
+            for _ in range(pool_settings["maxconn"] + 1):
+                connection = self.get().getconn()
+                if healthy(connection):
+                    connection.autocommit = True
+                    return connection
+                self.get().putconn(connection, close=True)
+            raise OperationalError("no healthy database connection available")
+        except Exception:
+            self.slots.release()
+            raise
+
+    def checkin(self, connection, broken=False):
+        try:
+            if not broken and not healthy(connection):
+                try:
+                    connection.rollback()
+                except OperationalError:
+                    broken = True
+            self.get().putconn(connection, close=broken or connection.closed)
+        finally:
+            self.slots.release()
+
+
+# Database
+primary = Pool(db_settings)
+router = Router([Pool({**settings, "connect_timeout": replica_timeout}) for settings in replica_settings])
+inherited = []
+
+
+def forget_pools():
+    for pool in [primary, *router.replicas]:
+        pool.forget()
+
+
+register_at_fork(after_in_child=forget_pools)
+
+
+@lru_cache(maxsize=None)
+def pyformat(query):
+    # Queries are written with asyncpg-style $n placeholders, psycopg2 wants %(n)s
+    return sub(r"\$(\d+)", r"%(\1)s", query.replace("%", "%%"))
+
+
+def execute(cursor, query, args):
+    if isinstance(query, Query):
+        # Parsed and planned once per connection, afterwards only the values are sent
+        if query.name not in cursor.connection.prepared:
+            cursor.execute(f"PREPARE {query.name} AS {query.sql}")
+            cursor.connection.prepared.add(query.name)
+        cursor.execute(f"EXECUTE {query.name} ({', '.join(['%s'] * len(args))})" if args else f"EXECUTE {query.name}",
+                       args)
+    elif args:
+        cursor.execute(pyformat(query), {str(i): arg for i, arg in enumerate(args, 1)})
+    else:
+        cursor.execute(query)
+
+
+def copy_text(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class QueueWriter:
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write(self, data):
+        self.queue.put(data.encode("utf-8") if isinstance(data, str) else bytes(data))
+
+
+class Database:
+    # The connection is checked out on the first query, so requests answered without the
+    # database (e.g. from the cache) never wait on the pool. Read-only ones try the replicas.
+    def __init__(self, read=False):
+        self.read = read
+        self.pool = None
+        self.connection = None
+        self.broken = False
+        self.savepoints = 0
+
+    async def connect(self):
+        if self.connection is None:
+            started = perf_counter()
+            for pool in router.candidates() if self.read else []:
+                try:
+                    self.connection = await to_thread.run_sync(pool.checkout)
+                    self.pool = pool
+                    break
+                except OperationalError:
+                    router.down(pool)
+                except PoolError:
+                    pass
+            if self.connection is None:
+                self.connection = await to_thread.run_sync(primary.checkout)
+                self.pool = primary
+            stats.pool_wait.observe(perf_counter() - started)
+        return self.connection
+
+    async def release(self):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            await to_thread.run_sync(self.pool.checkin, connection, self.broken)
+            if self.broken and self.pool is not primary:
+                router.down(self.pool)
+
+    def guard(self, func, *args):
+        try:
+            return func(*args)
+        except OperationalError:
+            self.broken = True
+            raise
+
+    def run(self, query, args, result):
+        with self.connection.cursor() as cursor:
+            execute(cursor, query, args)
+            return result(cursor), cursor.rowcount
+
+    async def query(self, query, args, result):
+        await self.connect()
+        started = perf_counter()
+        value, rows = await to_thread.run_sync(self.guard, self.run, query, args, result)
+        stats.observe(query, args, perf_counter() - started, rows)
+        return value
+
+    async def fetch(self, query, *args):
+        return await self.query(query, args, lambda cursor: cursor.fetchall())
+
+    async def fetchrow(self, query, *args):
+        return await self.query(query, args, lambda cursor: cursor.fetchone())
+
+    async def fetchval(self, query, *args):
+        row = await self.fetchrow(query, *args)
+        return row[0] if row else None
+
+    async def execute(self, query, *args):
+        return await self.query(query, args, lambda cursor: cursor.rowcount)
+
+    async def iterate(self, query, *args, size=500):
+        # Server-side cursor, rows are pulled in batches instead of materializing the result
+        async with self.transaction():
+            # psycopg2 only allows WITH HOLD cursors on autocommit connections, the explicit
+            # transaction still scopes it and it is closed before the commit
+            cursor = self.connection.cursor(name=f"iterate_{id(self)}", withhold=True)
+            started, count = perf_counter(), 0
+            try:
+                await to_thread.run_sync(self.guard, execute, cursor, query, args)
+                while rows := await to_thread.run_sync(self.guard, cursor.fetchmany, size):
+                    count += len(rows)
+                    for row in rows:
+                        yield row
+            finally:
+                # Includes the time the consumer spent between batches
+                stats.observe(query, args, perf_counter() - started, count)
+                if not self.broken:
+                    await to_thread.run_sync(cursor.close)
+
+    async def copy_records(self, table, columns, records):
+        # COPY FROM STDIN in text format: tab separated, \N for NULL
+        buffer = StringIO()
+        for record in records:
+            buffer.write("\t".join(copy_text(value) for value in record) + "\n")
+        buffer.seek(0)
+        await self.connect()
+        sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+        await to_thread.run_sync(self.guard, self.run_copy, sql, buffer)
+
+    async def copy_csv(self, query, *args, queue_size=16):
+        # COPY (query) TO STDOUT runs on its own thread and hands chunks over a bounded queue,
+        # so a slow client pauses the export instead of buffering it
+        await self.connect()
+        if args:
+            # COPY takes no parameters, psycopg2 quotes the values into the statement instead
+            with self.connection.cursor() as cursor:
+                query = cursor.mogrify(pyformat(query), {str(i): arg for i, arg in enumerate(args, 1)}).decode()
+        sql = f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)"
+        chunks = Queue(queue_size)
+
+        def produce():
+            try:
+                self.guard(self.run_copy, sql, QueueWriter(chunks))
+                chunks.put(None)
+            except Exception as error:
+                chunks.put(error)
+
+        def drain():
+            while (chunk := chunks.get()) is not None and not isinstance(chunk, Exception):
+                pass
+
+        producer = Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while (chunk := await to_thread.run_sync(chunks.get)) is not None:
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            if producer.is_alive():
+                # The consumer went away, stop the server side and let the thread finish
+                self.connection.cancel()
+                await to_thread.run_sync(drain)
+
+    def run_copy(self, sql, file):
+        with self.connection.cursor() as cursor:
+            cursor.copy_expert(sql, file)
+
+    @asynccontextmanager
+    async def transaction(self):
+        # Inside a transaction that is already open (e.g. a test's) the block becomes a savepoint
+        await self.connect()
+        if self.connection.get_transaction_status() == TRANSACTION_STATUS_IDLE:
+            begin, commit, rollback = "BEGIN", "COMMIT", "ROLLBACK"
+        else:
+            self.savepoints += 1
+            name = f"nested_{self.savepoints}"
+            begin, commit, rollback = f"SAVEPOINT {name}", f"RELEASE {name}", f"ROLLBACK TO {name}"
+        await self.execute(begin)
+        try:
+            yield self
+        except BaseException:
+            if not self.broken:
+                await self.execute(rollback)
+            raise
+        await self.execute(commit)
+
+
+@asynccontextmanager
+async def database(read=False):
+    db = Database(read)
+    try:
+        yield db
+    finally:
+        await db.release()
+
+
+async def get_db():
+    async with database() as db:
+        yield db
+
+
+async def listen(channel, callback, ready, keepalive=30):
+    # Own connection outside the pool, waited on by the event loop; callback(payload) runs there
+    # for every notification. Returns only by raising once the connection is lost.
+    connection = await to_thread.run_sync(lambda: connect(**db_settings))
+    try:
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {channel}")
+        ready()
+        while True:
+            with move_on_after(keepalive) as idle:
+                await wait_socket_readable(connection)
+            if idle.cancel_called:
+                # Nothing arrived for a while, make sure the server is still there
+                await to_thread.run_sync(lambda: connection.cursor().execute("SELECT 1"))
+            connection.poll()
+            while connection.notifies:
+                callback(connection.notifies.pop(0).payload)
+    finally:
+        connection.close()
+
+
+async def close():
+    for pool in [primary, *router.replicas]:
+        await to_thread.run_sync(pool.close)
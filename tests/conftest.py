@@ -0,0 +1,128 @@
+import anyio
+import pytest
+import sys
+
+from contextlib import AsyncExitStack
+from dotenv import load_dotenv
+from fastapi.testclient import TestClient
+from os import environ, path, getcwd
+from psycopg2 import connect
+
+dotenv_path = path.abspath(path.join(path.dirname(__file__), '..', '.env'))
+if path.exists(dotenv_path):
+    load_dotenv(dotenv_path)
+environ["TEST"] = "True"
+sys.path.append(getcwd())
+# The database named in .env, kept aside as the workers inherit the controller's environment
+server_db = environ.setdefault('POSTGRES_TEST_SERVER_DB', environ.get('POSTGRES_TEST_DB'))
+db_settings = {"user": environ.get('POSTGRES_USER'),
+               "password": environ.get('POSTGRES_PASSWORD'),
+               "host": environ.get('POSTGRES_TEST_HOST'),
+               "port": int(environ.get('POSTGRES_TEST_PORT'))}
+TABLES = "menus, submenus, dishes"
+
+
+def pytest_configure(config):
+    # Every pytest-xdist worker (or the single process without -n) gets a database of its own
+    # on the test server, named after it. The app reads its settings when the tests import it.
+    worker = getattr(config, "workerinput", {}).get("workerid", "main")
+    environ["POSTGRES_TEST_DB"] = f"{server_db}_{worker}"
+
+
+def server(query):
+    connection = connect(database=server_db, **db_settings)
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+    finally:
+        connection.close()
+
+
+async def migrate_database():
+    # In one event loop, the async engine's pool can't be closed from another one
+    from db.dbconnection import close
+    from db.migrate import migrate
+    try:
+        await migrate()
+    finally:
+        await close()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def worker_database():
+    name = environ["POSTGRES_TEST_DB"]
+    server(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+    server(f'CREATE DATABASE "{name}"')
+    anyio.run(migrate_database)
+    yield name
+    server(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+
+
+@pytest.fixture(scope="session")
+def client(worker_database):
+    # Entered once, so the requests and the tests' own database calls (client.portal.call) share
+    # one event loop with whichever engine is configured. The pools close with it.
+    import app.api
+    with TestClient(app.api.app) as client:
+        yield client
+
+
+@pytest.fixture(scope="session")
+def session(worker_database):
+    connection = connect(database=worker_database, **db_settings)
+    cursor = connection.cursor()
+    yield cursor
+    connection.close()
+
+
+class Rollback(Exception):
+    pass
+
+
+async def begin():
+    from db.dbconnection import database
+    stack = AsyncExitStack()
+    db = await stack.enter_async_context(database())
+    # Opened like the handlers' own, which then become savepoints in it with either engine
+    await stack.enter_async_context(db.transaction())
+    # Restarting the id sequences is transactional too, every test sees ids from 1
+    await db.execute(f"TRUNCATE {TABLES} RESTART IDENTITY")
+    return db, stack
+
+
+async def rollback(stack):
+    # Leaving the transaction with an exception rolls it back, then the connection is released
+    await stack.__aexit__(Rollback, Rollback(), None)
+
+
+@pytest.fixture
+def transaction(client):
+    # The handlers share one connection whose transaction is rolled back after the test, their
+    # own transactions become savepoints. Nothing is visible to other connections.
+    import app.api
+    db, stack = client.portal.call(begin)
+
+    async def get_db():
+        yield db
+
+    app.api.app.dependency_overrides[app.api.get_db] = get_db
+    app.api.app.dependency_overrides[app.api.get_read_db] = get_db
+    client.portal.call(app.api.cache.clear)
+    try:
+        yield db
+    finally:
+        app.api.app.dependency_overrides.clear()
+        client.portal.call(rollback, stack)
+
+
+@pytest.fixture
+def committed(session, client):
+    # For tests that look at the data from other connections (LISTEN, fork, the async engine)
+    import app.api
+    session.execute(f"TRUNCATE {TABLES} RESTART IDENTITY")
+    session.connection.commit()
+    client.portal.call(app.api.cache.clear)
+    yield
+    session.execute(f"TRUNCATE {TABLES} RESTART IDENTITY")
+    session.connection.commit()
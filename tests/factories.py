@@ -0,0 +1,36 @@
+# Test data goes in through the API, each builder returns the created body
+
+MENUS = "/api/v1/menus"
+
+
+def menu(client, **fields):
+    response = client.post(MENUS, json={"title": "My menu 1", "description": "My menu description 1", **fields})
+    assert response.status_code == 201
+    return response.json()
+
+
+def submenu(client, menu_id, **fields):
+    response = client.post(f"{MENUS}/{menu_id}/submenus",
+                           json={"title": "My submenu 1", "description": "My submenu description 1", **fields})
+    assert response.status_code == 201
+    return response.json()
+
+
+def dish(client, menu_id, submenu_id, **fields):
+    response = client.post(f"{MENUS}/{menu_id}/submenus/{submenu_id}/dishes",
+                           json={"title": "My dish 1", "description": "My dish description 1", "price": "12.50",
+                                 **fields})
+    assert response.status_code == 201
+    return response.json()
+
+
+def full_menu(client):
+    # Menu 1: submenu 1 (dishes 1, 2) and submenu 2 (dish 3)
+    # Menu 2: submenu 3 (dish 4) and submenu 4 (empty)
+    # Menu 3: empty
+    for submenus in [[2, 1], [1, 0], []]:
+        menu_id = menu(client)["id"]
+        for dishes in submenus:
+            submenu_id = submenu(client, menu_id)["id"]
+            for _ in range(dishes):
+                dish(client, menu_id, submenu_id)
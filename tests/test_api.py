@@ -1,76 +1,64 @@
+import anyio
+import json
+import os
 import pytest
-import sys
 
-from dotenv import load_dotenv
-from fastapi.testclient import TestClient
-from os import environ, path, getcwd
-from psycopg2 import connect
+from asyncio import create_task, sleep, wait_for
 
-sys.path.append(getcwd())
-environ["TEST"] = "True"
+# The settings are prepared in conftest.py, each test gets its own data from the factories
 import app.api
+import app.cache
+from app import admission
+import db.asyncdb
+import db.stats
+import db.syncdb
+from db.bulk import load
+from db.reconcile import reconcile
+from db.dbconnection import close, database
+from db import queries
+from tests import factories
 
 
-client = TestClient(app.api.app)
-
-@pytest.fixture(scope="session")
-def session():
-    dotenv_path = path.abspath(path.join(path.dirname(__file__), '..', '.env'))
-    if path.exists(dotenv_path):
-        load_dotenv(dotenv_path)
-    db_settings = {"database": environ.get('POSTGRES_TEST_DB'),
-                   "user": environ.get('POSTGRES_USER'),
-                   "password": environ.get('POSTGRES_PASSWORD'),
-                   "host": environ.get('POSTGRES_TEST_HOST'),
-                   "port": int(environ.get('POSTGRES_PORT'))}
-    connection = connect(**db_settings)
-    cursor = connection.cursor()
-    app.api.cursor = cursor
-    yield cursor
-    connection.close()
-
+@pytest.fixture
+def menu(client, transaction):
+    return factories.menu(client)["id"]
 
 @pytest.fixture
-def setup_db(session):
-    session.execute("""
-    DROP TABLE IF EXISTS menus, submenus, dishes;
-    CREATE TABLE menus (
-        id SERIAL PRIMARY KEY, 
-        title VARCHAR(150), 
-        description VARCHAR(150));
-    CREATE TABLE submenus (
-        id SERIAL PRIMARY KEY, 
-        menu INT REFERENCES menus (id) ON DELETE CASCADE,
-        title VARCHAR(150), description VARCHAR(150));
-    CREATE TABLE dishes (
-        id SERIAL PRIMARY KEY, 
-        submenu INT REFERENCES submenus (id) ON DELETE CASCADE,
-        title VARCHAR(150),
-        description VARCHAR(150),
-        price VARCHAR(150))
-    """)
-    session.connection.commit()
+def submenu(client, menu):
+    return menu, factories.submenu(client, menu)["id"]
 
-@pytest.fixture(scope="session")
-def item():
-    return {"menu": None, "submenu": None, "dish": None}
+@pytest.fixture
+def dish(client, submenu):
+    return (*submenu, factories.dish(client, *submenu)["id"])
 
-def test_get_menus(session, setup_db, item):
+def test_get_menus(client, transaction):
     response = client.get("/api/v1/menus")
     assert response.status_code == 200
     assert response.json() == []
 
-def test_get_menu():
+def test_get_menu(client, transaction):
     response = client.get("/api/v1/menus/1")
     assert response.status_code == 404
     assert response.json() == {"detail": "menu not found"}
 
-def test_create_menu():
+    # Ids beyond the INT columns are turned away before they reach the database
+    for url in ["/api/v1/menus/99999999999", "/api/v1/menus?after=99999999999",
+                "/api/v1/menus/1/submenus/99999999999/dishes", "/api/v1/menus/1/submenus/1/dishes?after=99999999999",
+                "/api/v1/menus/1/submenus/1/dishes?order_by=price&after=1.00,99999999999"]:
+        assert client.get(url).status_code == 422
+    # So are prices beyond NUMERIC(10, 2) and ones that aren't finite
+    for query in ["min_price=1e999999", "max_price=1.005", "min_price=NaN", "order_by=price&after=1e999999,1",
+                  "order_by=price&after=NaN,1", "order_by=-price&after=Infinity,1", "order_by=price&after=1.005,1"]:
+        assert client.get(f"/api/v1/menus/1/submenus/1/dishes?{query}").status_code == 422
+    response = client.post("/api/v1/batch", json=[{"method": "DELETE", "path": "/api/v1/menus/99999999999"}])
+    assert response.status_code == 422
+
+def test_create_menu(client, transaction):
     # Create menu
     data_req = {"title": "My menu 1", "description": "My menu description 1"}
     response = client.post("/api/v1/menus", json=data_req)
-    item.menu = response.json()["id"]
-    data_res = {"id": item.menu, "title": "My menu 1", "description": "My menu description 1"}
+    menu = response.json()["id"]
+    data_res = {"id": menu, "title": "My menu 1", "description": "My menu description 1"}
     assert response.status_code == 201
     assert response.json() == data_res
 
@@ -82,213 +70,170 @@ def test_create_menu():
     assert response.json() == [data_res]
 
     # Check whether it was added or not (by id)
-    response = client.get(f"/api/v1/menus/{item.menu}")
+    response = client.get(f"/api/v1/menus/{menu}")
     assert response.status_code == 200
     assert response.json() == data_res
 
-def test_update_menu():
+def test_update_menu(client, menu):
     # Update menu
     data_req = {"title": "My updated menu 1", "description": "My updated menu description 1"}
-    data_res = {"id": item.menu, "title": "My updated menu 1", "description": "My updated menu description 1"}
-    response = client.patch(f"/api/v1/menus/{item.menu}", json=data_req)
+    data_res = {"id": menu, "title": "My updated menu 1", "description": "My updated menu description 1"}
+    response = client.patch(f"/api/v1/menus/{menu}", json=data_req)
     assert response.status_code == 200
     assert response.json() == data_res
 
     # Check whether it was updated or not
-    response = client.get(f"/api/v1/menus/{item.menu}")
+    response = client.get(f"/api/v1/menus/{menu}")
     data_res["submenus_count"] = 0
     data_res["dishes_count"] = 0
     assert response.status_code == 200
     assert response.json() == data_res
 
-def test_delete_menu():
+def test_delete_menu(client, menu):
     # Delete menu
-    response = client.delete(f"/api/v1/menus/{item.menu}")
+    response = client.delete(f"/api/v1/menus/{menu}")
     assert response.status_code == 200
 
     # Check whether it was deleted or not
-    response = client.get(f"/api/v1/menus/{item.menu}")
+    response = client.get(f"/api/v1/menus/{menu}")
     assert response.status_code == 404
     assert response.json() == {"detail": "menu not found"}
 
-@pytest.fixture
-def setup_menu():
-    data_req = {"title": "My menu 1", "description": "My menu description 1"}
-    response = client.post("/api/v1/menus", json=data_req)
-    item.menu = response.json()["id"]
-
-def test_get_submenus():
-    response = client.get(f"/api/v1/menus/{item.menu}/submenus")
+def test_get_submenus(client, menu):
+    response = client.get(f"/api/v1/menus/{menu}/submenus")
     assert response.status_code == 200
     assert response.json() == []
 
-def test_get_submenu():
-    response = client.get(f"/api/v1/menus/{item.menu}/submenus/1")
+def test_get_submenu(client, menu):
+    response = client.get(f"/api/v1/menus/{menu}/submenus/1")
     assert response.status_code == 404
     assert response.json() == {"detail": "submenu not found"}
 
-def test_create_submenu(setup_menu):
+def test_create_submenu(client, menu):
     # Create submenu
     data_req = {"title": "My submenu 1", "description": "My submenu description 1"}
-    response = client.post(f"/api/v1/menus/{item.menu}/submenus", json=data_req)
-    item.submenu = response.json()["id"]
-    data_res = {"id": item.submenu, "title": "My submenu 1", "description": "My submenu description 1"}
+    response = client.post(f"/api/v1/menus/{menu}/submenus", json=data_req)
+    submenu = response.json()["id"]
+    data_res = {"id": submenu, "title": "My submenu 1", "description": "My submenu description 1"}
     assert response.status_code == 201
     assert response.json() == data_res
 
     # Check whether it was added or not (all submenus)
-    response = client.get(f"/api/v1/menus/{item.menu}/submenus")
+    response = client.get(f"/api/v1/menus/{menu}/submenus")
     data_res["dishes_count"] = 0
     assert response.status_code == 200
     assert response.json() == [data_res]
 
     # Check whether it was added or not (by id)
-    response = client.get(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}")
+    response = client.get(f"/api/v1/menus/{menu}/submenus/{submenu}")
     assert response.status_code == 200
     assert response.json() == data_res
 
-def test_update_submenu():
+def test_update_submenu(client, submenu):
+    menu, submenu = submenu
     # Update submenu
     data_req = {"title": "My updated menu 1", "description": "My updated menu description 1"}
-    data_res = {"id": item.submenu, "title": "My updated menu 1", "description": "My updated menu description 1"}
-    response = client.patch(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}", json=data_req)
+    data_res = {"id": submenu, "title": "My updated menu 1", "description": "My updated menu description 1"}
+    response = client.patch(f"/api/v1/menus/{menu}/submenus/{submenu}", json=data_req)
     assert response.status_code == 200
     assert response.json() == data_res
 
     # Check whether it was updated or not (by id)
-    response = client.get(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}")
+    response = client.get(f"/api/v1/menus/{menu}/submenus/{submenu}")
     data_res["dishes_count"] = 0
     assert response.status_code == 200
     assert response.json() == data_res
 
-def test_delete_submenu():
+def test_delete_submenu(client, submenu):
+    menu, submenu = submenu
     # Delete submenu
-    response = client.delete(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}")
+    response = client.delete(f"/api/v1/menus/{menu}/submenus/{submenu}")
     assert response.status_code == 200
 
     # Check whether it was deleted or not
-    response = client.get(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}")
+    response = client.get(f"/api/v1/menus/{menu}/submenus/{submenu}")
     assert response.status_code == 404
     assert response.json() == {"detail": "submenu not found"}
 
 # Dishes
 
-@pytest.fixture
-def setup_submenu():
-    data_req = {"title": "My submenu 1", "description": "My submenu description 1"}
-    response = client.post(f"/api/v1/menus/{item.menu}/submenus", json=data_req)
-    item.submenu = response.json()["id"]
-
-def test_get_dishes():
-    response = client.get(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes")
+def test_get_dishes(client, submenu):
+    menu, submenu = submenu
+    response = client.get(f"/api/v1/menus/{menu}/submenus/{submenu}/dishes")
     assert response.status_code == 200
     assert response.json() == []
 
-def test_get_dish():
-    response = client.get(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes/1")
+def test_get_dish(client, submenu):
+    menu, submenu = submenu
+    response = client.get(f"/api/v1/menus/{menu}/submenus/{submenu}/dishes/1")
     assert response.status_code == 404
     assert response.json() == {"detail": "dish not found"}
 
-def test_create_dish(setup_submenu):
+def test_create_dish(client, submenu):
+    menu, submenu = submenu
     # Create dish
     data_req = {"title": "My dish 1", "description": "My dish description 1", "price": "12.50"}
-    response = client.post(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes", json=data_req)
-    item.dish = response.json()["id"]
-    data_res = {"id": item.dish, "title": "My dish 1", "description": "My dish description 1", "price": "12.50"}
+    response = client.post(f"/api/v1/menus/{menu}/submenus/{submenu}/dishes", json=data_req)
+    dish = response.json()["id"]
+    data_res = {"id": dish, "title": "My dish 1", "description": "My dish description 1", "price": "12.50"}
     assert response.status_code == 201
     assert response.json() == data_res
 
     # Check whether it was added or not (all submenus)
-    response = client.get(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes")
+    response = client.get(f"/api/v1/menus/{menu}/submenus/{submenu}/dishes")
     assert response.status_code == 200
     assert response.json() == [data_res]
 
     # Check whether it was added or not (by id)
-    response = client.get(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes/{item.dish}")
+    response = client.get(f"/api/v1/menus/{menu}/submenus/{submenu}/dishes/{dish}")
     assert response.status_code == 200
     assert response.json() == data_res
 
-def test_update_dish():
+def test_update_dish(client, dish):
+    menu, submenu, dish = dish
     # Update dish
     data_req = {"title": "My updated dish 1", "description": "My updated dish description 1", "price": "14.50"}
-    data_res = {"id": item.dish, "title": "My updated dish 1", "description": "My updated dish description 1", "price": "14.50"}
-    response = client.patch(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes/{item.dish}", json=data_req)
+    data_res = {"id": dish, "title": "My updated dish 1", "description": "My updated dish description 1", "price": "14.50"}
+    response = client.patch(f"/api/v1/menus/{menu}/submenus/{submenu}/dishes/{dish}", json=data_req)
     assert response.status_code == 200
     assert response.json() == data_res
 
     # Check whether it was updated or not (by id)
-    response = client.get(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes/{item.dish}")
+    response = client.get(f"/api/v1/menus/{menu}/submenus/{submenu}/dishes/{dish}")
     assert response.status_code == 200
     assert response.json() == data_res
 
-def test_delete_dish():
+def test_delete_dish(client, dish):
+    menu, submenu, dish = dish
+    # Under another menu's path the dish doesn't exist for writes either
+    before = client.get(f"/api/v1/menus/{menu}/submenus/{submenu}/dishes/{dish}").json()
+    client.patch(f"/api/v1/menus/999/submenus/{submenu}/dishes/{dish}",
+                 json={"title": "Moved", "description": "", "price": "1"})
+    client.delete(f"/api/v1/menus/999/submenus/{submenu}/dishes/{dish}")
+    client.portal.call(app.api.cache.clear)
+    assert client.get(f"/api/v1/menus/{menu}/submenus/{submenu}/dishes/{dish}").json() == before
+
     # Delete submenu
-    response = client.delete(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes/{item.dish}")
+    response = client.delete(f"/api/v1/menus/{menu}/submenus/{submenu}/dishes/{dish}")
     assert response.status_code == 200
 
     # Check whether it was deleted or not
-    response = client.get(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes/{item.dish}")
+    response = client.get(f"/api/v1/menus/{menu}/submenus/{submenu}/dishes/{dish}")
     assert response.status_code == 404
     assert response.json() == {"detail": "dish not found"}
 
-# Data asset to check submenu and dishes counters
-@pytest.fixture(scope="function")
-def setup_full_menu(session):
-    session.execute("""
-    DROP TABLE IF EXISTS menus, submenus, dishes;
-    CREATE TABLE menus (
-        id SERIAL PRIMARY KEY,
-        title VARCHAR(150),
-        description VARCHAR(150));
-    CREATE TABLE submenus (
-        id SERIAL PRIMARY KEY,
-        menu INT REFERENCES menus (id) ON DELETE CASCADE,
-        title VARCHAR(150), description VARCHAR(150));
-    CREATE TABLE dishes (
-        id SERIAL PRIMARY KEY,
-        submenu INT REFERENCES submenus (id) ON DELETE CASCADE,
-        title VARCHAR(150),
-        description VARCHAR(150),
-        price VARCHAR(150))
-    """)
-    data_menu = {"title": "My menu 1", "description": "My menu description 1"}
-    data_submenu = {"title": "My submenu 1", "description": "My submenu description 1"}
-    data_dish = {"title": "My dish 1", "description": "My dish description 1", "price": "12.50"}
-
-    ###############################################################################
-    # Menu 1 (2 Submenus, 3 Dishes)
-    item.menu = client.post("/api/v1/menus", json=data_menu).json()["id"]
-
-    # Submenu 1 (2 Dishes)
-    item.submenu = client.post(f"/api/v1/menus/{item.menu}/submenus", json=data_submenu).json()["id"]
-    # Dish 1
-    client.post(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes", json=data_dish)
-    # Dish 2
-    client.post(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes", json=data_dish)
-    #
-    # Submenu 2 (1 Dishes)
-    item.submenu = client.post(f"/api/v1/menus/{item.menu}/submenus", json=data_submenu).json()["id"]
-    # Dish 3
-    client.post(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes", json=data_dish)
-    ###############################################################################
-    # Menu 2 (2 Submenus, 1 Dish)
-    item.menu = client.post("/api/v1/menus", json=data_menu).json()["id"]
-    #
-    # Submenu 3 (1 Dish)
-    item.submenu = client.post(f"/api/v1/menus/{item.menu}/submenus", json=data_submenu).json()["id"]
-    # Dish 4
-    client.post(f"/api/v1/menus/{item.menu}/submenus/{item.submenu}/dishes", json=data_dish)
-    #
-    # Submenu 4 (Empty)
-    item.submenu = client.post(f"/api/v1/menus/{item.menu}/submenus", json=data_submenu).json()["id"]
-    ###############################################################################
-    # Menu 3 (Empty)
-    client.post("/api/v1/menus", json=data_menu)
+# Data asset to check submenu and dishes counters, see factories.full_menu
+@pytest.fixture
+def full_menu(client, transaction):
+    factories.full_menu(client)
 
-    session.connection.commit()
+# The same, committed for tests that read it from other connections
+@pytest.fixture
+def committed_full_menu(client, committed):
+    factories.full_menu(client)
 
 # Check submenus and dishes counters
-def test_full_menu(session, setup_full_menu):
+def test_full_menu(client, full_menu):
     response = client.get("/api/v1/menus")
     data_res = response.json()
     assert response.status_code == 200
@@ -301,7 +246,7 @@ def test_full_menu(session, setup_full_menu):
     assert data_res[2]["dishes_count"] == 0
 
 # Check dishes counter
-def test_full_submenu(session, setup_full_menu):
+def test_full_submenu(client, full_menu):
     response = client.get("/api/v1/menus/1/submenus")
     data_res = response.json()
     assert response.status_code == 200
@@ -309,9 +254,526 @@ def test_full_submenu(session, setup_full_menu):
     assert data_res[0]["dishes_count"] == 2
     assert data_res[1]["dishes_count"] == 1
 
+# Lists are built by orjson or returned as JSON by Postgres, both give the same bodies
+@pytest.fixture(params=["python", "postgres"])
+def list_json(request, monkeypatch):
+    monkeypatch.setattr(app.api, "list_json", request.param)
+
+# Walk the collections page by page
+def test_full_pages(client, full_menu, list_json):
+    response = client.get("/api/v1/menus?limit=2")
+    assert response.status_code == 200
+    assert [menu["id"] for menu in response.json()] == ["1", "2"]
+    assert response.headers["X-Next-Cursor"] == "2"
+    assert response.headers["Link"] == '<http://testserver/api/v1/menus?limit=2&after=2>; rel="next"'
+
+    response = client.get("/api/v1/menus?limit=2&after=2")
+    assert [menu["id"] for menu in response.json()] == ["3"]
+    assert "Link" not in response.headers
+
+    response = client.get("/api/v1/menus/1/submenus/1/dishes?limit=1&fields=id,price")
+    assert response.json() == [{"id": "1", "price": "12.50"}]
+    response = client.get("/api/v1/menus/1/submenus/1/dishes?limit=1&fields=id,price&after=1")
+    assert response.json() == [{"id": "2", "price": "12.50"}]
+    assert "Link" not in response.headers
+
+    response = client.get("/api/v1/menus/1/submenus?fields=title,dishes_count")
+    assert response.json() == [{"title": "My submenu 1", "dishes_count": 2}, {"title": "My submenu 1", "dishes_count": 1}]
+
+    # Fields come in the projection's order, a permutation reuses the same statement
+    statements = set(db.stats.statements)
+    bodies = {client.get(f"/api/v1/menus/1/submenus/1/dishes?fields={fields}").text
+              for fields in ["price,id,title", "title,id,price", "id,price,title,id"]}
+    assert len(bodies) == 1 and list(json.loads(bodies.pop())[0]) == ["id", "title", "price"]
+    assert len(set(db.stats.statements) - statements) <= 1
+
+    response = client.get("/api/v1/menus?fields=id,secret")
+    assert response.status_code == 422
+    assert response.json() == {"detail": "unknown fields: secret"}
+
+# Check the nested tree matches the counters
+def test_full_tree(client, full_menu):
+    response = client.get("/api/v1/menus/tree")
+    data_res = response.json()
+    assert response.status_code == 200
+    assert [len(menu["submenus"]) for menu in data_res] == [2, 2, 0]
+    assert [len(submenu["dishes"]) for submenu in data_res[0]["submenus"]] == [2, 1]
+    assert data_res[0]["submenus"][0]["dishes"][0] == {"id": "1", "title": "My dish 1",
+                                                       "description": "My dish description 1", "price": "12.50"}
+
+    response = client.get("/api/v1/menus/2/tree")
+    assert response.status_code == 200
+    assert response.json() == data_res[1]
+
+    response = client.get("/api/v1/menus/4/tree")
+    assert response.status_code == 404
+
 # Check cascade delete
-def test_full_delete(session, setup_full_menu):
+def test_full_delete(client, full_menu):
     client.delete(f"/api/v1/menus/1")
     response = client.get("/api/v1/menus/1")
     assert response.status_code == 404
-    assert response.json() == {"detail": "menu not found"}
\ No newline at end of file
+    assert response.json() == {"detail": "menu not found"}
+# Import nested menus in bulk and round-trip them through the exports
+def test_bulk(client, transaction):
+    data_req = [{"title": "My menu 1", "description": "My menu description 1", "submenus": [
+        {"title": "My submenu 1", "description": "My submenu description 1", "dishes": [
+            {"title": "My dish 1", "description": "My dish description 1", "price": "12.50"},
+            {"title": "My dish 2", "description": "My dish description 2", "price": "13.50"}]},
+        {"title": "My submenu 2", "description": "My submenu description 2"}]},
+        {"title": "My menu 2", "description": "My menu description 2"}]
+    response = client.post("/api/v1/import", json=data_req)
+    assert response.status_code == 201
+    assert response.json() == {"menus": 2, "submenus": 2, "dishes": 2}
+
+    response = client.get("/api/v1/menus")
+    assert [(m["submenus_count"], m["dishes_count"]) for m in response.json()] == [(2, 2), (0, 0)]
+    response = client.get("/api/v1/menus/1/submenus/1/dishes")
+    assert [dish["price"] for dish in response.json()] == ["12.50", "13.50"]
+
+    response = client.get("/api/v1/export")
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert [json.loads(line)["title"] for line in lines] == ["My menu 1", "My menu 2"]
+
+    response = client.get("/api/v1/export?format=csv")
+    assert response.status_code == 200
+    assert len(response.text.splitlines()) == 5
+
+    response = client.post("/api/v1/import/csv", content=response.content, headers={"Content-Type": "text/csv"})
+    assert response.status_code == 201
+    assert response.json() == {"menus": 2, "submenus": 2, "dishes": 2}
+    response = client.get("/api/v1/menus/3/tree")
+    assert response.json()["submenus"][0]["dishes"][1]["title"] == "My dish 2"
+
+    # CSV prices get the same check as the API's, too long or too precise is a 422
+    header = "menu_title,menu_description,submenu_title,submenu_description,dish_title,dish_description,dish_price\n"
+    for price in ["123456789012", "1.005", "abc"]:
+        response = client.post("/api/v1/import/csv", content=header + f"M,M,S,S,D,D,{price}\n")
+        assert response.status_code == 422
+    response = client.post("/api/v1/import/csv", content=header + f"M,M,S,S,{'D' * 151},D,1\n")
+    assert response.status_code == 422
+    assert len(client.get("/api/v1/menus").json()) == 4
+
+# Reads are served from the cache until a write below them invalidates it
+def test_cache(client, full_menu):
+    stats = client.get("/api/v1/cache").json()
+    response = client.get("/api/v1/menus")
+    assert client.get("/api/v1/menus").json() == response.json()
+    assert client.get("/api/v1/cache").json()["hits"] == stats["hits"] + 1
+
+    data_dish = {"title": "My dish 5", "description": "My dish description 5", "price": "9.90"}
+    client.post("/api/v1/menus/1/submenus/1/dishes", json=data_dish)
+    assert client.get("/api/v1/menus").json()[0]["dishes_count"] == 4
+    assert client.get("/api/v1/menus/1").json()["dishes_count"] == 4
+    assert client.get("/api/v1/menus/1/submenus/1").json()["dishes_count"] == 3
+
+    client.delete("/api/v1/menus/1")
+    assert client.get("/api/v1/menus/1/submenus/1").status_code == 404
+    assert len(client.get("/api/v1/menus").json()) == 2
+
+    # Parameters the routes don't declare share the body, and the size counts every query string
+    client.portal.call(app.api.cache.clear)
+    for junk in range(3):
+        assert client.get(f"/api/v1/menus?junk={junk}").status_code == 200
+    assert client.get("/api/v1/cache").json()["size"] == 1
+    small = app.cache.MemoryCache(4, 60)
+    for limit in range(1, 11):
+        client.portal.call(small.set, "/default/api/v1/menus", f"limit={limit}", b"[]")
+    assert small.stats()["size"] == 4 and list(small.entries["/default/api/v1/menus"]) == [
+        f"limit={limit}" for limit in range(7, 11)]
+    client.portal.call(small.invalidate, "/default/api/v1/menus/1")
+    assert (small.entries, small.stats()["size"]) == ({}, 0)
+
+# Check counters after a cascade delete of a submenu
+def test_full_delete_counters(client, full_menu):
+    client.delete("/api/v1/menus/1/submenus/1")
+    response = client.get("/api/v1/menus/1")
+    assert response.json()["submenus_count"] == 1
+    assert response.json()["dishes_count"] == 1
+
+# Counters drifted by hand are repaired from the rows
+def test_reconcile(client, session, committed_full_menu):
+    session.execute("UPDATE menus SET submenus_count = 7, dishes_count = 7 WHERE id = 1")
+    session.execute("UPDATE submenus SET dishes_count = 7 WHERE id = 3")
+    session.connection.commit()
+    assert client.portal.call(reconcile) == {"menus": 1, "submenus": 1}
+    client.portal.call(app.api.cache.clear)
+
+    response = client.get("/api/v1/menus")
+    assert [(m["submenus_count"], m["dishes_count"]) for m in response.json()] == [(2, 3), (2, 1), (0, 0)]
+    assert client.get("/api/v1/menus/2/submenus/3").json()["dishes_count"] == 1
+
+    # The endpoint also drops the cached bodies
+    session.execute("UPDATE menus SET dishes_count = 7 WHERE id = 2")
+    session.connection.commit()
+    client.portal.call(app.api.cache.clear)
+    assert client.get("/api/v1/menus").json()[1]["dishes_count"] == 7
+    # Only the caller's tenant is repaired
+    assert client.post("/t/acme/api/v1/reconcile").json() == {"menus": 0, "submenus": 0}
+    assert client.get("/api/v1/menus").json()[1]["dishes_count"] == 7
+    assert client.post("/api/v1/reconcile").json() == {"menus": 1, "submenus": 0}
+    assert client.get("/api/v1/menus").json()[1]["dishes_count"] == 1
+
+def test_prices(client, full_menu, list_json):
+    url = "/api/v1/menus/1/submenus/1/dishes"
+    for price in ["3", "7.5", "20.00"]:
+        client.post(url, json={"title": "Priced", "description": "Priced", "price": price})
+    assert client.post(url, json={"title": "Bad", "description": "Bad", "price": "1.005"}).status_code == 422
+
+    response = client.get(url + "?fields=id,price&min_price=5&max_price=15")
+    assert response.json() == [{"id": "1", "price": "12.50"}, {"id": "2", "price": "12.50"},
+                               {"id": "6", "price": "7.50"}]
+    response = client.get(url + "?fields=price&order_by=price&limit=2")
+    assert response.json() == [{"price": "3.00"}, {"price": "7.50"}]
+    assert response.headers["x-next-cursor"] == "7.50,6"
+    response = client.get(url + "?fields=id&order_by=price&limit=2&after=7.50,6")
+    assert response.json() == [{"id": "1"}, {"id": "2"}]
+    response = client.get(url + "?fields=price&order_by=-price&limit=1")
+    assert response.json() == [{"price": "20.00"}]
+    assert client.get(url + "?order_by=price&after=abc").status_code == 422
+
+    response = client.get("/api/v1/menus/1/submenus/1/stats")
+    assert response.json() == {"dishes": 5, "min_price": "3.00", "avg_price": "11.10", "max_price": "20.00"}
+    response = client.get("/api/v1/menus/1/stats")
+    assert response.json() == {"dishes": 6, "min_price": "3.00", "avg_price": "11.33", "max_price": "20.00"}
+    response = client.get("/api/v1/menus/3/stats")
+    assert response.json() == {"dishes": 0, "min_price": None, "avg_price": None, "max_price": None}
+    response = client.get("/api/v1/menus/99/stats")
+    assert (response.status_code, response.json()) == (404, {"detail": "menu not found"})
+    response = client.get("/api/v1/menus/2/submenus/1/stats")
+    assert (response.status_code, response.json()) == (404, {"detail": "submenu not found"})
+
+def test_batch(client, full_menu):
+    client.get("/api/v1/menus/1")
+    response = client.post("/api/v1/batch", json=[
+        {"method": "POST", "path": "/api/v1/menus", "body": {"title": "Lunch", "description": "New"}},
+        {"method": "POST", "path": "/api/v1/menus/$0/submenus", "body": {"title": "Soups", "description": ""}},
+        {"method": "POST", "path": "/api/v1/menus/$0/submenus/$1/dishes",
+         "body": {"title": "Borscht", "description": "", "price": "4.5"}},
+        {"method": "PATCH", "path": "/api/v1/menus/1", "body": {"title": "Renamed", "description": ""}},
+        {"method": "DELETE", "path": "/api/v1/menus/1/submenus/1/dishes/1"}])
+    assert response.status_code == 200
+    assert response.json() == [
+        {"status": 201, "body": {"id": "4", "title": "Lunch", "description": "New"}},
+        {"status": 201, "body": {"id": "5", "title": "Soups", "description": ""}},
+        {"status": 201, "body": {"id": "5", "title": "Borscht", "description": "", "price": "4.50"}},
+        {"status": 200, "body": {"id": "1", "title": "Renamed", "description": ""}},
+        {"status": 200, "body": None}]
+    assert client.get("/api/v1/menus/4").json()["dishes_count"] == 1
+    assert client.get("/api/v1/menus/1").json()["title"] == "Renamed"
+    assert client.get("/api/v1/menus/1").json()["dishes_count"] == 2
+
+    # One failing operation rolls back the ones before it
+    for operations, status in [
+            ([{"method": "PATCH", "path": "/api/v1/menus/2", "body": {"title": "Lost", "description": ""}},
+              {"method": "DELETE", "path": "/api/v1/menus/2/submenus/1"}], 404),
+            ([{"method": "PATCH", "path": "/api/v1/menus/2", "body": {"title": "Lost", "description": ""}},
+              {"method": "POST", "path": "/api/v1/menus/2/submenus", "body": {"title": "No description"}}], 422),
+            ([{"method": "PATCH", "path": "/api/v1/menus/2", "body": {"title": "Lost", "description": ""}},
+              {"method": "POST", "path": "/api/v1/menus/$1/submenus", "body": {"title": "", "description": ""}}], 422),
+            ([{"method": "PATCH", "path": "/api/v1/menus/2", "body": {"title": "Lost", "description": ""}},
+              {"method": "PATCH", "path": "/api/v1/menus", "body": {"title": "", "description": ""}}], 422)]:
+        assert client.post("/api/v1/batch", json=operations).status_code == status
+    # Text longer than its column is the operation's 422, not a database error
+    response = client.post("/api/v1/batch", json=[
+        {"method": "PATCH", "path": "/api/v1/menus/2", "body": {"title": "Lost", "description": ""}},
+        {"method": "POST", "path": "/api/v1/menus", "body": {"title": "x" * 151, "description": ""}}])
+    assert response.status_code == 422 and response.json()["detail"].startswith("operation 1: ")
+    response = client.post("/api/v1/import", json=[{"title": "", "description": "x" * 151}])
+    assert response.status_code == 422
+    assert client.get("/api/v1/menus/2").json()["title"] == "My menu 1"
+    assert client.post("/api/v1/menus/3/submenus/1/dishes", json={"title": "", "description": "", "price": "1"}
+                       ).status_code == 404
+
+def test_changes(client, committed_full_menu):
+    changes = app.api.changes
+
+    async def scenario():
+        assert await changes.start()
+        queue, backlog = changes.subscribe("default")
+        assert backlog == []
+        async with database() as db:
+            await db.execute(queries.UPDATE_MENU, "default", "Renamed", "", 1)
+            await db.execute(queries.DELETE_DISH, "default", 1, 1, 1)
+            await load(db, [{"title": "Imported", "description": "", "submenus": []}], "default")
+        chunks = [await wait_for(queue.get(), 5) for _ in range(3)]
+        await changes.stop()
+        return chunks
+
+    chunks = client.portal.call(scenario)
+    events = [json.loads(chunk.decode().split("data: ")[1]) for chunk in chunks]
+    # The counter updates and the bulk load's rows stay quiet
+    assert [(e["entity"], e["op"], e["id"], e["menu_id"], e["submenu_id"]) for e in events] == [
+        ("menu", "update", "1", "1", None), ("dish", "delete", "1", "1", "1"), ("menu", "import", None, None, None)]
+    assert events[0]["version"] and events[1]["version"] is None
+    assert chunks[0].startswith(f"id: {events[0]['event']}\nevent: change\n".encode())
+
+    # Reconnecting clients get what they missed, or a reset when their token is too old
+    changes.events.extend((e["event"], e["tenant"], chunk) for e, chunk in zip(events, chunks))
+    assert changes.subscribe("default", events[0]["event"])[1] == chunks[1:]
+    assert changes.subscribe("default", "0")[1] == [changes.RESET]
+    changes.subscribers.clear()
+    changes.events.clear()
+
+def test_search(client, full_menu):
+    client.post("/api/v1/menus/2/submenus/3/dishes", json={"title": "Борщ", "description": "Soup", "price": "5"})
+    client.post("/api/v1/menus/1/submenus/2/dishes", json={"title": "Soup", "description": "Tomato", "price": "4"})
+    response = client.get("/api/v1/search?q=SOUP")
+    assert response.status_code == 200
+    # Title matches rank above description matches, each hit carries its parents
+    assert [(hit["title"], hit["menu_id"], hit["submenu_id"]) for hit in response.json()] == [
+        ("Soup", "1", "2"), ("Борщ", "2", "3")]
+    assert "etag" not in response.headers
+    assert client.get("/api/v1/search?q=бор&fields=id,price").json() == [{"id": "5", "price": "5.00"}]
+    assert client.get("/api/v1/search?q=dish description 1").json()[0]["title"] == "My dish 1"
+
+    response = client.get("/api/v1/search?q=dish&fields=id&limit=3")
+    assert response.json() == [{"id": "1"}, {"id": "2"}, {"id": "3"}]
+    response = client.get(f"/api/v1/search?q=dish&fields=id&after={response.headers['x-next-cursor']}")
+    assert response.json() == [{"id": "4"}]
+
+    # Updates are searchable right away
+    client.patch("/api/v1/menus/1/submenus/1/dishes/1", json={"title": "Pancakes", "description": "", "price": "1"})
+    assert client.get("/api/v1/search?q=pancake&fields=id").json() == [{"id": "1"}]
+    assert client.get("/api/v1/search?q=!&|").status_code == 422
+
+def test_etag(client, full_menu):
+    response = client.get("/api/v1/menus/1")
+    etag = response.headers["etag"]
+    response = client.get("/api/v1/menus/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    client.portal.call(app.api.cache.clear)
+    assert client.get("/api/v1/menus/1", headers={"If-None-Match": etag}).status_code == 304
+    dishes = client.get("/api/v1/menus/1/submenus/1/dishes")
+    assert client.get("/api/v1/menus/1/submenus/1/dishes", headers={"If-None-Match": dishes.headers["etag"]}
+                      ).status_code == 304
+    fields = client.get("/api/v1/menus/1/submenus/1/dishes?fields=id")
+    assert fields.headers["etag"] != dishes.headers["etag"]
+
+    # A new dish changes the dish list, the submenu and the menu (their counters moved)
+    submenu = client.get("/api/v1/menus/1/submenus/1").headers["etag"]
+    client.post("/api/v1/menus/1/submenus/1/dishes", json={"title": "New", "description": "New", "price": "1.00"})
+    for url, old in [("/api/v1/menus/1", etag), ("/api/v1/menus/1/submenus/1", submenu),
+                     ("/api/v1/menus/1/submenus/1/dishes", dishes.headers["etag"])]:
+        response = client.get(url, headers={"If-None-Match": old})
+        assert response.status_code == 200
+        assert response.headers["etag"] != old
+
+    # Renaming a dish leaves the submenu alone
+    submenu = client.get("/api/v1/menus/1/submenus/1").headers["etag"]
+    client.patch("/api/v1/menus/1/submenus/1/dishes/1", json={"title": "Renamed", "description": "", "price": "1"})
+    assert client.get("/api/v1/menus/1/submenus/1", headers={"If-None-Match": submenu}).status_code == 304
+
+    # Without If-None-Match the tag is read with the body, no version query runs
+    client.portal.call(app.api.cache.clear)
+    counts = {name: statement.duration.count for name, statement in db.stats.statements.items()}
+    menu = client.get("/api/v1/menus/1")
+    menus = client.get("/api/v1/menus?limit=2")
+    assert {name for name, statement in db.stats.statements.items()
+            if statement.duration.count != counts.get(name)} == {"get_menu", menus_statement()}
+    client.portal.call(app.api.cache.clear)
+    assert client.get("/api/v1/menus/1", headers={"If-None-Match": menu.headers["etag"]}).status_code == 304
+    assert client.get("/api/v1/menus?limit=2", headers={"If-None-Match": menus.headers["etag"]}).status_code == 304
+    # A page's tag covers only its rows, a change on the next page leaves it alone
+    client.patch("/api/v1/menus/3", json={"title": "Renamed", "description": ""})
+    assert client.get("/api/v1/menus?limit=2", headers={"If-None-Match": menus.headers["etag"]}).status_code == 304
+    client.patch("/api/v1/menus/2", json={"title": "Renamed", "description": ""})
+    assert client.get("/api/v1/menus?limit=2", headers={"If-None-Match": menus.headers["etag"]}).status_code == 200
+
+def menus_statement():
+    names = list(queries.GET_MENUS.columns)
+    return (queries.GET_MENUS.select_json if app.api.list_json == "postgres" else queries.GET_MENUS.select)(names).name
+
+def test_metrics(client, full_menu):
+    client.get("/api/v1/menus/1")
+    client.get("/api/v1/menus/1/submenus/404")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    metrics = response.text
+    assert 'http_requests_total{method="GET",route="/api/v1/menus/{target_menu_id}",status="200"}' in metrics
+    assert 'route="/api/v1/menus/{target_menu_id}/submenus/{target_submenu_id}",status="404"}' in metrics
+    assert 'db_query_duration_seconds_bucket{query="get_menu",le="+Inf"}' in metrics
+    assert 'db_query_rows_total{query="get_submenu"}' in metrics
+    assert "db_pool_wait_seconds_count" in metrics
+
+async def admission_queue():
+    limiter = admission.Limiter(1, 1, 0.05)
+    assert await limiter.acquire() is None
+    waiting = create_task(limiter.acquire())
+    await sleep(0)
+    assert await limiter.acquire() == "queue_full"
+    # The slot goes straight to the waiting request
+    limiter.release()
+    assert await waiting is None and limiter.active == 1
+    assert await limiter.acquire() == "timeout"
+    limiter.release()
+    return limiter
+
+def test_admission(client, full_menu, monkeypatch):
+    limiter = client.portal.call(admission_queue)
+    assert (limiter.active, len(limiter.waiters), limiter.rejected) == (0, 0, {"queue_full": 1, "timeout": 1})
+
+    # Writes over capacity are turned away at once, reads are limited separately
+    busy = admission.Limiter(1, 0, 1)
+    busy.active = 1
+    monkeypatch.setitem(admission.limiters, "write", busy)
+    response = client.post("/api/v1/menus", json={"title": "New", "description": "New"})
+    assert (response.status_code, response.headers["retry-after"]) == (503, "1")
+    assert client.get("/api/v1/menus/1").status_code == 200
+    assert 'admission_rejected_total{kind="write",reason="queue_full"} 1' in client.get("/metrics").text
+
+    monkeypatch.setattr(admission, "rate_limiter", admission.RateLimiter(0.5, 2))
+    assert [client.get("/api/v1/menus/1").status_code for _ in range(3)] == [200, 200, 429]
+    assert client.get("/api/v1/menus/1").headers["retry-after"] == "2"
+    assert "rate_limited_total 2" in client.get("/metrics").text
+
+def test_tenants(client, full_menu, monkeypatch):
+    # full_menu belongs to the default tenant, acme starts out empty
+    acme = {"X-Tenant": "acme"}
+    assert client.get("/api/v1/menus", headers=acme).json() == []
+    response = client.post("/api/v1/batch", headers=acme, json=[
+        {"method": "POST", "path": "/api/v1/menus", "body": {"title": "Acme", "description": ""}},
+        {"method": "POST", "path": "/api/v1/menus/$0/submenus", "body": {"title": "Soups", "description": ""}},
+        {"method": "POST", "path": "/api/v1/menus/$0/submenus/$1/dishes",
+         "body": {"title": "Tomato soup", "description": "", "price": "3"}}])
+    menu_id = response.json()[0]["body"]["id"]
+    assert client.post("/t/acme/api/v1/menus", json={"title": "My menu 1", "description": ""}).status_code == 201
+    menus = client.get("/t/acme/api/v1/menus").json()
+    assert [(menu["title"], menu["dishes_count"]) for menu in menus] == [("Acme", 1), ("My menu 1", 0)]
+    assert client.get("/api/v1/menus", headers=acme).json() == menus
+    assert len(client.get("/api/v1/menus").json()) == 3
+
+    # Rows of another tenant don't exist for this one, cached or not
+    assert client.get(f"/api/v1/menus/{menu_id}").status_code == 404
+    assert client.post(f"/api/v1/menus/{menu_id}/submenus", json={"title": "", "description": ""}).status_code == 404
+    assert client.get("/api/v1/menus/1").status_code == 200
+    assert client.get("/api/v1/menus/1", headers=acme).status_code == 404
+    assert [hit["title"] for hit in client.get("/api/v1/search?q=soup", headers=acme).json()] == ["Tomato soup"]
+    assert client.get("/api/v1/search?q=soup").json() == []
+    assert len(client.get("/api/v1/export?format=csv", headers=acme).text.splitlines()) == 3
+
+    # Links keep the path prefix, header routed answers vary on it
+    response = client.get("/t/acme/api/v1/menus?limit=1")
+    assert "/t/acme/api/v1/menus?limit=1&after=" in response.headers["link"]
+    assert "vary" not in response.headers
+    assert client.get("/api/v1/menus").headers["vary"] == "X-Tenant"
+
+    assert client.get("/api/v1/menus", headers={"X-Tenant": "Not valid"}).status_code == 400
+    assert client.get("/t/-acme/api/v1/menus").status_code == 400
+    monkeypatch.setattr(app.tenants, "default_tenant", "")
+    assert client.get("/api/v1/menus").json() == {"detail": "tenant required"}
+
+    # Subscribers only get their tenant's events
+    changes = app.api.changes
+    queue, _ = changes.subscribe("acme")
+    for tenant in ["default", "acme"]:
+        changes.publish(json.dumps({"event": tenant, "tenant": tenant}))
+    assert queue.qsize() == 1 and changes.subscribe("acme", "default")[1] == [queue.get_nowait()]
+    changes.subscribers.clear()
+    changes.events.clear()
+
+async def menu_title():
+    async with database() as db:
+        return await db.fetchval("SELECT title FROM menus WHERE id = 1")
+
+async def child_menu_title():
+    # The child has no event loop of its own yet, it closes its pool in the one it opened it in
+    try:
+        return await menu_title()
+    finally:
+        await close()
+
+# A forked worker opens its own connections and leaves the parent's sessions alone
+def test_fork(client, committed_full_menu):
+    assert client.portal.call(menu_title) == "My menu 1"
+    pid = os.fork()
+    if pid == 0:
+        title = None
+        try:
+            title = anyio.run(child_menu_title)
+        finally:
+            os._exit(0 if title == "My menu 1" else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert client.portal.call(menu_title) == "My menu 1"
+
+async def application_names(read, times=3):
+    names = []
+    for _ in range(times):
+        async with db.syncdb.database(read) as connection:
+            names.append(await connection.fetchval("SELECT current_setting('application_name')"))
+    return names
+
+def test_replicas(client, full_menu, monkeypatch):
+    replica = db.syncdb.Pool({**db.syncdb.db_settings, "application_name": "replica"})
+    dead = db.syncdb.Pool({**db.syncdb.db_settings, "port": 1, "connect_timeout": 1})
+    monkeypatch.setattr(db.syncdb.router, "replicas", [dead, replica])
+    monkeypatch.setattr(db.syncdb.router, "down_until", {})
+    try:
+        # The unreachable replica is skipped and then left out, writes stay on the primary
+        assert client.portal.call(application_names, True) == ["replica"] * 3
+        assert db.syncdb.router.candidates() == [replica]
+        assert "replica" not in client.portal.call(application_names, False)
+    finally:
+        replica.close()
+
+    monkeypatch.setattr(app.api, "replica_settings", [db.syncdb.db_settings])
+    response = client.post("/api/v1/menus", json={"title": "New", "description": "New"})
+    assert "ylab_primary=1" in response.headers["set-cookie"]
+    assert "Max-Age=5" in response.headers["set-cookie"]
+    # The writer's reads skip the cache both ways, a replica may have cached what it just changed
+    client.portal.call(app.api.cache.clear)
+    hits, misses = app.api.cache.hits, app.api.cache.misses
+    assert client.get("/api/v1/menus/1").status_code == 200
+    assert (app.api.cache.hits, app.api.cache.misses, app.api.cache.stats()["size"]) == (hits, misses, 0)
+    client.cookies.clear()
+    client.get("/api/v1/menus/1")
+    assert app.api.cache.stats()["size"] == 1
+    # Replica bodies are cached no longer than the writer keeps to the primary
+    monkeypatch.setattr(app.cache, "replica_settings", [db.syncdb.db_settings])
+    assert app.cache.create_cache().ttl == 5
+
+async def prepared_statements():
+    async with database() as db:
+        first = await db.fetchrow(queries.GET_MENU, "default", 1)
+        second = await db.fetchrow(queries.GET_MENU, "default", 1)
+        # Named get_menu by the sync engine and by asyncpg's cache with the async one, found by its text
+        prepared = await db.fetchval("SELECT count(*) FROM pg_prepared_statements WHERE strpos(statement, $1) > 0",
+                                     queries.GET_MENU.sql)
+    return first, second, prepared
+
+def test_prepared_statements(client, committed_full_menu):
+    first, second, prepared = client.portal.call(prepared_statements)
+    assert first == second and first[:5] == ("1", "My menu 1", "My menu description 1", 2, 3)
+    assert prepared == 1
+    assert queries.GET_MENUS.select(["title", "id"]).name == "get_menus_1_0"
+
+# Same routes served by the asyncpg engine
+def test_async_engine(client, committed):
+    app.api.app.dependency_overrides[app.api.get_db] = db.asyncdb.get_db
+    app.api.app.dependency_overrides[app.api.get_read_db] = db.asyncdb.get_db
+    try:
+        data_req = {"title": "My menu 1", "description": "My menu description 1"}
+        response = client.post("/api/v1/menus", json=data_req)
+        assert response.status_code == 201
+        menu = response.json()["id"]
+
+        response = client.get(f"/api/v1/menus/{menu}")
+        assert response.status_code == 200
+        assert response.json() == {"id": menu, **data_req, "submenus_count": 0, "dishes_count": 0}
+
+        response = client.get("/api/v1/menus/tree")
+        assert response.status_code == 200
+        assert response.json() == [{"id": menu, **data_req, "submenus": []}]
+
+        response = client.post("/api/v1/batch", json=[
+            {"method": "POST", "path": f"/api/v1/menus/{menu}/submenus", "body": data_req},
+            {"method": "DELETE", "path": f"/api/v1/menus/{menu}/submenus/404"}])
+        assert response.status_code == 404
+        assert client.get(f"/api/v1/menus/{menu}").json()["submenus_count"] == 0
+    finally:
+        app.api.app.dependency_overrides.clear()
+        client.portal.call(db.asyncdb.close)